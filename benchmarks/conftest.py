@@ -0,0 +1,70 @@
+"""
+Fixtures for the benchmark suite.
+
+Run the benchmarks with ``python -m pytest benchmarks``. Hierarchy sizes
+default to 10^3 and 10^4 sequela; set EPIC_DB_BENCHMARK_SIZES to a comma
+separated list, e.g. ``1000,10000,100000``, to change them.
+"""
+import os
+
+import pytest
+
+from epic_db.database import config, create_db, delete_db
+
+from synthetic import load_synthetic
+
+try:
+    import pytest_benchmark  # noqa: F401
+except ImportError:
+    # the benchmark fixture comes from pytest-benchmark
+    collect_ignore_glob = ['test_*.py']
+
+SIZES_ENV_VAR = 'EPIC_DB_BENCHMARK_SIZES'
+DEFAULT_SIZES = (1000, 10000)
+
+
+def benchmark_sizes():
+    sizes = os.environ.get(SIZES_ENV_VAR)
+    if not sizes:
+        return list(DEFAULT_SIZES)
+    return [int(size) for size in sizes.split(',')]
+
+
+def pytest_generate_tests(metafunc):
+    if 'n_sequela' in metafunc.fixturenames:
+        metafunc.parametrize('n_sequela', benchmark_sizes())
+
+
+class SyntheticDb(object):
+    """A freshly loaded synthetic sequela set, committed to the default
+    engine."""
+
+    def __init__(self, n_sequela, n_versions=1):
+        delete_db()
+        create_db()
+        self.session = config.Session()
+        self.version_ids, self.rows = load_synthetic(
+            self.session, n_sequela, n_versions=n_versions)
+        self.session.commit()
+
+    def close(self):
+        self.session.close()
+        delete_db()
+
+
+@pytest.fixture
+def synthetic_db():
+    """Return a function loading a fresh synthetic set. Every set loaded is
+    dropped at the end of the test, so it can be used as benchmark setup."""
+    loaded = []
+
+    def load(n_sequela, n_versions=1):
+        if loaded:
+            loaded[-1].session.close()
+        db = SyntheticDb(n_sequela, n_versions=n_versions)
+        loaded.append(db)
+        return db
+
+    yield load
+    if loaded:
+        loaded[-1].close()
@@ -0,0 +1,149 @@
+"""
+Synthetic sequela hierarchies for benchmarking.
+
+The test fixtures in tests/conftest.py build a handful of rows through the ORM
+with a flush per row, which is far too slow for hierarchies of 10^3 - 10^5
+sequela. generate_hierarchy builds the rows of a balanced hierarchy in memory
+and load_synthetic bulk inserts them with executemany.
+"""
+import math
+
+import pandas as pd
+
+from epic_db.models import (Sequela, SequelaSet, SequelaSetVersion,
+                            SequelaHierarchyHistory, SequelaReiHistory)
+
+ROOT_ID = 0
+
+
+def generate_hierarchy(n_sequela, depth=3, n_causes=100, first_id=1):
+    """
+    Generate the rows of a balanced sequela hierarchy.
+
+    Sequela are added breadth first under a root sequela (id 0) with the same
+    number of children per parent, chosen so that n_sequela sequela fill
+    depth levels below the root. Sequela without children are most detailed.
+
+    Arguments:
+        n_sequela (int): the number of sequela below the root.
+
+        depth (int): the number of levels below the root.
+
+        n_causes (int): the number of distinct cause ids. Sequela share the
+            cause of their level 1 ancestor.
+
+        first_id (int): the sequela_id of the first sequela below the root.
+
+    Returns:
+        A list of dicts with the sequela_hierarchy_history columns of each
+            sequela, the root first, in breadth first order.
+    """
+    branching = max(2, int(math.ceil(n_sequela ** (1.0 / depth))))
+    root = {'sequela_id': ROOT_ID, 'parent_id': ROOT_ID, 'level': 0,
+            'path_to_top_parent': str(ROOT_ID), 'sequela_name': 'root',
+            'cause_id': None, 'sort_order': 0}
+    rows = [root]
+    frontier = [root]
+    next_id = first_id
+    for level in range(1, depth + 1):
+        children = []
+        for parent in frontier:
+            for _ in range(branching):
+                if len(rows) > n_sequela:
+                    break
+                if level == 1:
+                    cause_id = 300 + (next_id % n_causes)
+                else:
+                    cause_id = parent['cause_id']
+                child = {
+                    'sequela_id': next_id,
+                    'parent_id': parent['sequela_id'],
+                    'level': level,
+                    'path_to_top_parent': '{},{}'.format(
+                        parent['path_to_top_parent'], next_id),
+                    'sequela_name': 'sequela {}'.format(next_id),
+                    'cause_id': cause_id,
+                    'sort_order': len(rows)}
+                rows.append(child)
+                children.append(child)
+                next_id += 1
+        frontier = children
+
+    parents = set(row['parent_id'] for row in rows[1:])
+    for row in rows:
+        most_detailed = row['sequela_id'] not in parents
+        row['most_detailed'] = int(most_detailed)
+        row['modelable_entity_id'] = (
+            10000 + row['sequela_id'] if most_detailed else None)
+        row['healthstate_id'] = (
+            row['sequela_id'] % 50 if most_detailed else None)
+    return rows
+
+
+def load_synthetic(session, n_sequela, depth=3, n_versions=1, set_id=1,
+                   gbd_round_id=5, rei_every=10):
+    """
+    Bulk insert a synthetic sequela set into an empty schema.
+
+    Every version of the set gets a copy of the same hierarchy, and every
+    rei_every-th most detailed sequela gets a sequela_rei_history row.
+
+    Returns:
+        The list of sequela_set_version_ids created, and the hierarchy rows
+            from generate_hierarchy.
+    """
+    rows = generate_hierarchy(n_sequela, depth=depth)
+    version_ids = list(range(1, n_versions + 1))
+
+    session.execute(SequelaSet.__table__.insert(), [
+        {'sequela_set_id': set_id,
+         'sequela_set_name': 'synthetic set {}'.format(set_id)}])
+    session.execute(SequelaSetVersion.__table__.insert(), [
+        {'sequela_set_version_id': version_id, 'sequela_set_id': set_id,
+         'sequela_set_version': 'synthetic version {}'.format(version_id),
+         'gbd_round_id': gbd_round_id}
+        for version_id in version_ids])
+    session.execute(Sequela.__table__.insert(), [
+        {'sequela_id': row['sequela_id'],
+         'sequela_name': row['sequela_name']} for row in rows])
+
+    most_detailed = [row['sequela_id'] for row in rows
+                     if row['most_detailed']]
+    for version_id in version_ids:
+        session.execute(SequelaHierarchyHistory.__table__.insert(), [
+            dict(row, sequela_set_version_id=version_id,
+                 sequela_set_id=set_id) for row in rows])
+        session.execute(SequelaReiHistory.__table__.insert(), [
+            {'sequela_set_version_id': version_id, 'sequela_id': sequela_id,
+             'rei_id': 82} for sequela_id in most_detailed[::rei_every]])
+    session.flush()
+    return version_ids, rows
+
+
+def mapping_frame(rows, n_rows=None):
+    """
+    Build a converter mapping frame that puts the most detailed sequela of
+    rows under their current parents.
+
+    Arguments:
+        rows (list): hierarchy rows from generate_hierarchy.
+
+        n_rows (int): the number of most detailed sequela to include. Default
+            None includes all of them.
+
+    Returns:
+        A DataFrame with the cause_id, sequela_id, sequela_name and lvl_5_name
+            columns produced by XlsProcessor.
+    """
+    names = {row['sequela_id']: row['sequela_name'] for row in rows}
+    # level 1 sequela have no aggregate to map to
+    leaves = [row for row in rows
+              if row['most_detailed'] and row['level'] > 1]
+    if n_rows is not None:
+        leaves = leaves[:n_rows]
+    return pd.DataFrame({
+        'cause_id': [float(row['cause_id']) for row in leaves],
+        'sequela_id': [float(row['sequela_id']) for row in leaves],
+        'sequela_name': [row['sequela_name'] for row in leaves],
+        'lvl_5_name': [names[row['parent_id']] for row in leaves]},
+        columns=['cause_id', 'sequela_id', 'sequela_name', 'lvl_5_name'])
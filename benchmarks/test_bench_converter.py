@@ -0,0 +1,34 @@
+from scripts.converter import JsonConverter, XlsProcessor
+
+from synthetic import mapping_frame
+
+
+def test_create_hierarchy(benchmark, synthetic_db, n_sequela):
+    db = synthetic_db(n_sequela)
+    frame = mapping_frame(db.rows)
+
+    def convert():
+        converter = JsonConverter(frame, session=db.session)
+        return converter.create_hierarchy(version_id=db.version_ids[0])
+
+    output = benchmark(convert)
+    assert output['sequela_hierarchy_history']
+
+
+def test_create_all_most_detailed(benchmark, synthetic_db, n_sequela):
+    db = synthetic_db(n_sequela)
+    converter = JsonConverter(mapping_frame(db.rows))
+
+    output = benchmark(converter.create_all_most_detailed, version_id=1)
+    assert len(output['sequela']) == len(converter.most_detailed)
+
+
+def test_process_mapping_file(benchmark, synthetic_db, n_sequela, tmpdir):
+    db = synthetic_db(n_sequela)
+    path = str(tmpdir.join('mapping.csv'))
+    frame = mapping_frame(db.rows).rename(
+        columns={'lvl_5_name': 'Name level 5 hierarchy'})
+    frame.to_csv(path, index=False)
+
+    data = benchmark(XlsProcessor().run, path, chunksize=1000)
+    assert len(data) == len(frame)
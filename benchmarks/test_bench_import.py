@@ -0,0 +1,23 @@
+import subprocess
+import sys
+
+
+def import_module(module):
+    subprocess.check_call([sys.executable, '-c', 'import {}'.format(module)])
+
+
+def test_import_python(benchmark):
+    # the interpreter start up cost included in the timings below
+    benchmark(import_module, 'sys')
+
+
+def test_import_requests(benchmark):
+    benchmark(import_module, 'epic_db.requests')
+
+
+def test_import_activate(benchmark):
+    benchmark(import_module, 'epic_db.activate')
+
+
+def test_import_cli(benchmark):
+    benchmark(import_module, 'epic_db.cli')
@@ -0,0 +1,72 @@
+from epic_db.requests import RequestHandler
+
+# sequela touched by each request, independent of the hierarchy size
+REQUEST_ROWS = 100
+
+
+def most_detailed_ids(db, n=REQUEST_ROWS):
+    return [row['sequela_id'] for row in db.rows
+            if row['most_detailed'] and row['level'] > 1][:n]
+
+
+def process(db, request):
+    RequestHandler(db.session).process_request(request)
+    db.session.flush()
+
+
+def test_insert_sequela(benchmark, synthetic_db, n_sequela):
+    def setup():
+        db = synthetic_db(n_sequela)
+        request = {'sequela': [
+            {'sequela_id': None,
+             'sequela_name': 'new sequela {}'.format(i),
+             'sequela_hierarchy_history': {
+                 'sequela_set_version_id': db.version_ids[0],
+                 'cause_id': 294,
+                 'modelable_entity_id': 1109,
+                 'healthstate_id': 1}}
+            for i in range(REQUEST_ROWS)]}
+        return (db, request), {}
+
+    benchmark.pedantic(process, setup=setup, rounds=3)
+
+
+def test_modify_sequela(benchmark, synthetic_db, n_sequela):
+    def setup():
+        db = synthetic_db(n_sequela)
+        request = {'sequela': [
+            {'sequela_id': sequela_id,
+             'sequela_name': 'renamed {}'.format(sequela_id)}
+            for sequela_id in most_detailed_ids(db)]}
+        return (db, request), {}
+
+    benchmark.pedantic(process, setup=setup, rounds=3)
+
+
+def test_delete_sequela(benchmark, synthetic_db, n_sequela):
+    def setup():
+        db = synthetic_db(n_sequela)
+        request = {'sequela': [
+            {'sequela_id': sequela_id, 'is_delete': True}
+            for sequela_id in most_detailed_ids(db)]}
+        return (db, request), {}
+
+    benchmark.pedantic(process, setup=setup, rounds=3)
+
+
+def test_modify_hierarchy(benchmark, synthetic_db, n_sequela):
+    def setup():
+        db = synthetic_db(n_sequela)
+        # move the first REQUEST_ROWS most detailed sequela under the first
+        # level 1 aggregate
+        parent = next(row for row in db.rows
+                      if row['level'] == 1 and not row['most_detailed'])
+        request = {'sequela_hierarchy_history': [
+            {'sequela_set_version_id': db.version_ids[0],
+             'sequela_id': parent['sequela_id'],
+             'sequela_name': parent['sequela_name'],
+             'cause_id': parent['cause_id'],
+             'children': most_detailed_ids(db)}]}
+        return (db, request), {}
+
+    benchmark.pedantic(process, setup=setup, rounds=3)
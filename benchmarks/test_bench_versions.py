@@ -0,0 +1,38 @@
+from epic_db.activate import (activate_sequela_set_version,
+                              check_hierarchy_integrity,
+                              HIERARCHY_INTEGRITY_COLUMNS)
+from epic_db.models import SequelaHierarchyHistory, SequelaSet
+
+
+def test_backfill_version(benchmark, synthetic_db, n_sequela):
+    def setup():
+        db = synthetic_db(n_sequela)
+        return (db,), {}
+
+    def backfill(db):
+        sequela_set = db.session.query(SequelaSet).get(1)
+        sequela_set.add_version(sequela_set_version='backfilled',
+                                gbd_round_id=5, backfill=db.version_ids[0])
+        db.session.flush()
+
+    benchmark.pedantic(backfill, setup=setup, rounds=3)
+
+
+def test_activate_version(benchmark, synthetic_db, n_sequela):
+    def setup():
+        db = synthetic_db(n_sequela)
+        return (db.version_ids[0],), {'gbd_round_id': 5}
+
+    benchmark.pedantic(activate_sequela_set_version, setup=setup, rounds=3)
+
+
+def test_check_hierarchy_integrity(benchmark, synthetic_db, n_sequela):
+    db = synthetic_db(n_sequela)
+    columns = [getattr(SequelaHierarchyHistory, name)
+               for name in HIERARCHY_INTEGRITY_COLUMNS]
+    rows = db.session.query(*columns).filter(
+        SequelaHierarchyHistory.sequela_set_version_id ==
+        db.version_ids[0]).all()
+
+    failures = benchmark(check_hierarchy_integrity, rows)
+    assert not failures
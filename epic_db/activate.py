@@ -1,31 +1,261 @@
-from epic_db.database import config, session_scope
-from epic_db.models import SequelaSetVersion, SequelaSetVersionActive
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import sqlalchemy as sql
+
+from epic_db.database import (ReadOnlySession,
+                              config,
+                              session_scope,
+                              shares_one_connection)
+from epic_db.models import (Sequela,
+                            SequelaSetVersion,
+                            SequelaSetVersionActive,
+                            SequelaHierarchyHistory,
+                            SequelaReiHistory)
 from epic_db.errors import SequelaSetVersionValidationError
-from gbd.constants import GBD_ROUND_ID
-from db_tools.ezfuncs import get_engine
+from epic_db.profiling import profiled
 
 
+@profiled('activate_sequela_set_version')
 def activate_sequela_set_version(sequela_set_version_id,
-                                 gbd_round_id=GBD_ROUND_ID,
-                                 validate=True, conn_def=None):
+                                 gbd_round_id=None,
+                                 validate=True, conn_def=None,
+                                 max_workers=None, sync_names=False,
+                                 validators=None):
 
+    if gbd_round_id is None:
+        from gbd.constants import GBD_ROUND_ID
+        gbd_round_id = GBD_ROUND_ID
     if conn_def is not None:
-        config.engine = get_engine(conn_def=conn_def)
+        config.register_engine(conn_def=conn_def)
 
     with session_scope() as session:
         activate = ActivateSequelaVersion(
-            session, sequela_set_version_id, gbd_round_id)
+            session, sequela_set_version_id, gbd_round_id,
+            validators=validators)
+        if sync_names and activate.sync_sequela_names():
+            session.flush()
+            # validator worker sessions can't see the uncommitted renames
+            max_workers = None
         if validate:
-            activate.validate_version()
+            activate.validate_version(max_workers=max_workers)
         activate.activate_version()
 
 
+@profiled('activate_sequela_set_versions')
+def activate_sequela_set_versions(versions, validate=True, conn_def=None,
+                                  max_workers=None, validators=None):
+    """
+    Activate many sequela_set_versions in a single transaction.
+
+    All versions and their existing SequelaSetVersionActive rows are loaded
+    with one query each. If any version fails validation nothing is
+    activated.
+
+    Arguments:
+        versions (list of tuples): (sequela_set_version_id, gbd_round_id)
+            pairs to activate. At most one version may be activated per
+            sequela_set and gbd_round_id.
+
+        validate (bool): whether to validate every version before activating.
+            Default True.
+
+        conn_def (str): database connection definition. Default None uses the
+            currently configured engine.
+
+        max_workers (int): if greater than one, versions are validated
+            concurrently in a thread pool, each on its own session bound to
+            the same engine. Those sessions only see committed rows. Engines
+            with a single shared connection, like in-memory sqlite, always
+            validate sequentially.
+
+        validators (list of callables): validators to run on every version.
+            Default None runs the registered validators.
+
+    Raises:
+        ValueError: thrown if a version does not exist or if two versions of
+            the same sequela_set are activated for the same gbd_round_id.
+
+        SequelaSetVersionValidationError: thrown if any version fails
+            validation. The failures attribute maps sequela_set_version_ids to
+            their errors.
+    """
+    if conn_def is not None:
+        config.register_engine(conn_def=conn_def)
+
+    versions = [(int(version_id), int(gbd_round_id))
+                for version_id, gbd_round_id in versions]
+    if not versions:
+        return
+
+    with session_scope() as session:
+        version_rows = {row.sequela_set_version_id: row for row in
+                        session.query(SequelaSetVersion).filter(
+                            SequelaSetVersion.sequela_set_version_id.in_(
+                                [version_id for version_id, _ in versions]))}
+        missing = sorted(set(version_id for version_id, _ in versions) -
+                         set(version_rows))
+        if missing:
+            raise ValueError(
+                "Sequela_set_version_ids {} not found in "
+                "epic.sequela_set_version table.".format(missing))
+
+        active_keys = [(version_rows[version_id].sequela_set_id, gbd_round_id)
+                       for version_id, gbd_round_id in versions]
+        if len(set(active_keys)) != len(active_keys):
+            raise ValueError(
+                "Only one version per sequela_set and gbd_round_id can be "
+                "activated, got {}".format(versions))
+
+        if validate:
+            _validate_versions(session, versions, max_workers, validators)
+
+        existing = {(row.sequela_set_id, row.gbd_round_id): row for row in
+                    session.query(SequelaSetVersionActive).filter(
+                        SequelaSetVersionActive.sequela_set_id.in_(
+                            set(key[0] for key in active_keys)),
+                        SequelaSetVersionActive.gbd_round_id.in_(
+                            set(key[1] for key in active_keys)))}
+
+        new_active = [{'sequela_set_id': sequela_set_id,
+                       'gbd_round_id': gbd_round_id,
+                       'sequela_set_version_id': version_id}
+                      for (sequela_set_id, gbd_round_id), (version_id, _)
+                      in zip(active_keys, versions)]
+
+        if session.get_bind().dialect.name == 'mysql':
+            # single INSERT ... ON DUPLICATE KEY UPDATE statement
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            stmt = mysql_insert(SequelaSetVersionActive.__table__).values(
+                new_active)
+            session.execute(stmt.on_duplicate_key_update(
+                sequela_set_version_id=stmt.inserted.sequela_set_version_id))
+            for row in existing.values():
+                session.expire(row)
+        else:
+            for values in new_active:
+                key = (values['sequela_set_id'], values['gbd_round_id'])
+                if key in existing:
+                    existing[key].sequela_set_version_id = (
+                        values['sequela_set_version_id'])
+                else:
+                    session.add(SequelaSetVersionActive(**values))
+            session.flush()
+
+
+@contextmanager
+def _worker_session(bind):
+    """A read-only session on its own connection from bind's pool, for
+    validating in a worker thread. It only sees committed rows."""
+    session = ReadOnlySession(bind=bind, autoflush=False)
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+
+
+def _validate_version(bind, sequela_set_version_id, gbd_round_id,
+                      validators=None):
+    """Validate a single version on its own read-only session."""
+    with _worker_session(bind) as session:
+        ActivateSequelaVersion(
+            session, sequela_set_version_id, gbd_round_id,
+            validators=validators).validate_version()
+
+
+def _validate_versions(session, versions, max_workers=None,
+                       validators=None):
+    """Validate many versions, raising one error for all failures."""
+    failures = OrderedDict()
+    if (max_workers and max_workers > 1 and len(versions) > 1 and
+            not shares_one_connection(session.get_bind())):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(version_id, executor.submit(
+                _validate_version, session.get_bind(), version_id,
+                gbd_round_id, validators))
+                for version_id, gbd_round_id in versions]
+            for version_id, future in futures:
+                try:
+                    future.result()
+                except SequelaSetVersionValidationError as e:
+                    failures[version_id] = e
+    else:
+        for version_id, gbd_round_id in versions:
+            try:
+                ActivateSequelaVersion(
+                    session, version_id, gbd_round_id,
+                    validators=validators).validate_version()
+            except SequelaSetVersionValidationError as e:
+                failures[version_id] = e
+
+    if failures:
+        raise SequelaSetVersionValidationError(
+            "{count} sequela_set_version(s) failed validation:\n"
+            "{errors}".format(
+                count=len(failures),
+                errors='\n'.join(str(error) for error in failures.values())),
+            failures=failures)
+
+
+def register_validator(validator):
+    """
+    Add a validator to the checks run by
+    ActivateSequelaVersion.validate_version for every activation in the
+    process. Can be used as a decorator. To add checks for a single
+    activation, pass validators instead.
+
+    Arguments:
+        validator (callable): called with an ActivateSequelaVersion instance;
+            must raise SequelaSetVersionValidationError if the version fails
+            the check.
+
+    Returns:
+        The validator, unchanged.
+    """
+    ActivateSequelaVersion.validators.append(validator)
+    return validator
+
+
+def unregister_validator(validator):
+    """
+    Remove a validator added with register_validator.
+
+    Raises:
+        ValueError: thrown if the validator isn't registered.
+    """
+    ActivateSequelaVersion.validators.remove(validator)
+
+
+def _validator_name(validator):
+    return getattr(validator, '__name__', repr(validator))
+
+
+def _run_validator(bind, validator, sequela_set_version_id, gbd_round_id):
+    """Run a single validator on its own read-only session, and therefore on
+    its own connection from the pool."""
+    with _worker_session(bind) as session:
+        validator(ActivateSequelaVersion(
+            session, sequela_set_version_id, gbd_round_id))
+
+
 class ActivateSequelaVersion(object):
 
     def __init__(self, session, sequela_set_version_id,
-                 gbd_round_id):
+                 gbd_round_id, validators=None):
+        """
+        Validates and activates a sequela_set_version on session.
+
+        Arguments:
+            validators (list of callables): the validators validate_version
+                runs by default. Default None copies the registered
+                validators when the instance is created.
+        """
         self.session = session
         self.gbd_round_id = gbd_round_id
+        self.validators = list(type(self).validators if validators is None
+                               else validators)
         self.version = self.session.query(
             SequelaSetVersion).get(sequela_set_version_id)
         if not self.version:
@@ -34,19 +264,83 @@ class ActivateSequelaVersion(object):
                 "epic.sequela_set_version table.".format(
                     sequela_set_version_id))
 
-    def validate_version(self):
-        self.has_shh_for_rei()
+    def validate_version(self, validators=None, max_workers=None):
+        """
+        Run every validator against this version and report all failures
+        together.
+
+        Arguments:
+            validators (list of callables): validators to run. Defaults to
+                this instance's validators.
+
+            max_workers (int): if greater than one, validators run
+                concurrently in a thread pool, each on its own session bound
+                to the same engine as this session. Those sessions only see
+                committed rows, not changes pending in this session. Default
+                None runs them sequentially on this session, as does a
+                session whose engine has a single shared connection, like
+                in-memory sqlite.
+
+        Raises:
+            SequelaSetVersionValidationError: thrown if any validator fails.
+                The failures attribute maps validator names to their errors.
+        """
+        if validators is None:
+            validators = self.validators
+
+        failures = OrderedDict()
+        if (max_workers and max_workers > 1 and len(validators) > 1 and
+                not shares_one_connection(self.session.get_bind())):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [(validator, executor.submit(
+                    _run_validator, self.session.get_bind(), validator,
+                    self.version.sequela_set_version_id, self.gbd_round_id))
+                    for validator in validators]
+                for validator, future in futures:
+                    try:
+                        future.result()
+                    except SequelaSetVersionValidationError as e:
+                        failures[_validator_name(validator)] = e
+        else:
+            for validator in validators:
+                try:
+                    validator(self)
+                except SequelaSetVersionValidationError as e:
+                    failures[_validator_name(validator)] = e
+
+        if failures:
+            raise SequelaSetVersionValidationError(
+                "Sequela_set_version {version} failed {count} validation(s):"
+                "\n{errors}".format(
+                    version=self.version,
+                    count=len(failures),
+                    errors='\n'.join(
+                        '{}: {}'.format(name, error)
+                        for name, error in failures.items())),
+                failures=failures)
 
     def has_shh_for_rei(self):
+        """
+        Check that every sequela mapped to a rei in this version also has a
+        row in this version's hierarchy.
 
-        rei_sequela_ids = set(
-            [row.sequela_id for row in
-             self.version.fk_sequela_rei_history.all()])
-        shh_sequela_ids = set(
-            [row.sequela_id for row in
-             self.version.fk_sequela_hierarchy_history.all()])
+        The check is a single anti-join, so only the offending sequela_ids
+        are returned from the database.
 
-        missing_in_shh = list(rei_sequela_ids - shh_sequela_ids)
+        Raises:
+            SequelaSetVersionValidationError: thrown if any sequela_rei_history
+                rows have no corresponding sequela_hierarchy_history row.
+        """
+        version_id = self.version.sequela_set_version_id
+        missing_in_shh = [row.sequela_id for row in self.session.query(
+            SequelaReiHistory.sequela_id).filter(
+            SequelaReiHistory.sequela_set_version_id == version_id,
+            ~self.session.query(SequelaHierarchyHistory).filter(
+                SequelaHierarchyHistory.sequela_set_version_id ==
+                SequelaReiHistory.sequela_set_version_id,
+                SequelaHierarchyHistory.sequela_id ==
+                SequelaReiHistory.sequela_id).exists()).distinct().order_by(
+            SequelaReiHistory.sequela_id)]
 
         if missing_in_shh:
             raise SequelaSetVersionValidationError(
@@ -57,8 +351,74 @@ class ActivateSequelaVersion(object):
                     rei_rows=missing_in_shh,
                     version=self.version))
 
+    def has_valid_hierarchy(self):
+        """
+        Check the structural integrity of this version's hierarchy.
+
+        The hierarchy is loaded once as plain column tuples and checked by
+        check_hierarchy_integrity().
+
+        Raises:
+            SequelaSetVersionValidationError: thrown if any integrity check
+                fails. The message lists the offending sequela_ids for every
+                failed check.
+        """
+        rows = self.session.query(
+            *[getattr(SequelaHierarchyHistory, col)
+              for col in HIERARCHY_INTEGRITY_COLUMNS]).filter(
+            SequelaHierarchyHistory.sequela_set_version_id ==
+            self.version.sequela_set_version_id).all()
+
+        problems = check_hierarchy_integrity(rows)
+        if problems:
+            raise SequelaSetVersionValidationError(
+                "Hierarchy integrity checks failed for "
+                "sequela_set_version {version}: {problems}".format(
+                    version=self.version,
+                    problems='; '.join(
+                        '{}: sequela_ids {}'.format(check, ids)
+                        for check, ids in problems.items())))
+
+    validators = [has_shh_for_rei, has_valid_hierarchy]
+
     def sync_sequela_names(self):
-        pass
+        """
+        Copy current names from the sequela table into this version's
+        denormalized sequela_hierarchy_history.sequela_name column.
+
+        The out of sync rows are selected with a join on sequela and fixed
+        with a single UPDATE, so no hierarchy rows are loaded as ORM objects.
+
+        Returns:
+            A list of dicts with the sequela_id, old_name and new_name of
+                every hierarchy row that was changed.
+        """
+        current_name = sql.select([Sequela.sequela_name]).where(
+            Sequela.sequela_id ==
+            SequelaHierarchyHistory.sequela_id).as_scalar()
+        out_of_sync = sql.and_(
+            SequelaHierarchyHistory.sequela_set_version_id ==
+            self.version.sequela_set_version_id,
+            sql.or_(SequelaHierarchyHistory.sequela_name != current_name,
+                    sql.and_(SequelaHierarchyHistory.sequela_name.is_(None),
+                             current_name.isnot(None))))
+
+        changed = [{'sequela_id': row.sequela_id,
+                    'old_name': row.sequela_name,
+                    'new_name': row.new_name}
+                   for row in self.session.query(
+                       SequelaHierarchyHistory.sequela_id,
+                       SequelaHierarchyHistory.sequela_name,
+                       current_name.label('new_name')).filter(
+                       out_of_sync).order_by(
+                       SequelaHierarchyHistory.sequela_id)]
+
+        if changed:
+            self.session.query(SequelaHierarchyHistory).filter(
+                out_of_sync).update(
+                {SequelaHierarchyHistory.sequela_name: current_name},
+                synchronize_session='fetch')
+        return changed
 
     def activate_version(self):
         active_version = self.session.query(
@@ -75,3 +435,103 @@ class ActivateSequelaVersion(object):
             active_version.sequela_set_version_id = (
                 self.version.sequela_set_version_id)
         self.session.flush()
+
+
+HIERARCHY_INTEGRITY_COLUMNS = ['sequela_id', 'parent_id', 'level',
+                               'most_detailed', 'path_to_top_parent',
+                               'cause_id']
+
+
+def _int_column(values, fill=-1):
+    """Return an int64 array of values with None replaced by fill, and a
+    boolean mask marking where values were None."""
+    import numpy as np
+    values = np.array(values, dtype=object)
+    missing = np.equal(values, None)
+    values[missing] = fill
+    return values.astype(np.int64), missing
+
+
+def check_hierarchy_integrity(rows):
+    """
+    Check a sequela hierarchy for structural inconsistencies.
+
+    Every check is a single vectorized pass over column arrays, so the cost
+    is dominated by loading the rows rather than by the number of sequela.
+    Path checks are skipped for rows whose path_to_top_parent is null, and
+    cause_id checks are skipped wherever either cause_id is null.
+
+    Arguments:
+        rows (list of tuples): one tuple per sequela_hierarchy_history row,
+            ordered as HIERARCHY_INTEGRITY_COLUMNS.
+
+    Returns:
+        An OrderedDict mapping the name of each failed check to the sorted
+            list of offending sequela_ids. Empty if the hierarchy is valid.
+    """
+    import numpy as np
+
+    problems = OrderedDict()
+    if not rows:
+        return problems
+
+    (sequela_id, parent_id, level, most_detailed, path,
+     cause_id) = [list(col) for col in zip(*rows)]
+    sequela_id, _ = _int_column(sequela_id)
+    parent_id, parent_missing = _int_column(parent_id)
+    level, _ = _int_column(level)
+    most_detailed, _ = _int_column(most_detailed)
+    cause_id, cause_missing = _int_column(cause_id)
+    path = np.array(path, dtype=object)
+    has_path = ~np.equal(path, None)
+    path = np.where(has_path, path, '').astype(str)
+    n_rows = len(sequela_id)
+
+    def report(check, mask):
+        if mask.any():
+            problems[check] = sorted(int(i) for i in sequela_id[mask])
+
+    # locate each row's parent
+    sorter = np.argsort(sequela_id)
+    pos = np.searchsorted(sequela_id, parent_id, sorter=sorter)
+    parent_idx = sorter[np.clip(pos, 0, n_rows - 1)]
+    dangling = (sequela_id[parent_idx] != parent_id) | parent_missing
+    is_root = (parent_id == sequela_id) & ~parent_missing
+    has_parent = ~dangling & ~is_root
+
+    report('dangling parent_id', dangling)
+    if is_root.sum() != 1:
+        problems['expected exactly one root'] = sorted(
+            int(i) for i in sequela_id[is_root])
+
+    # pointer doubling: every row must reach a root or a dangling row
+    terminal = is_root | dangling
+    jump = np.where(terminal, np.arange(n_rows), parent_idx)
+    for _ in range(int(np.ceil(np.log2(max(n_rows, 2)))) + 1):
+        jump = jump[jump]
+    report('cycle', ~terminal[jump])
+
+    # level and path_to_top_parent
+    expected_level = np.where(is_root, 0, level[parent_idx] + 1)
+    report('level', (is_root | has_parent) & (level != expected_level))
+
+    depth = np.char.count(path, ',')
+    expected_path = np.char.add(
+        np.char.add(path[parent_idx], ','), sequela_id.astype(str))
+    report('path_to_top_parent',
+           has_path & ((depth != level) |
+                       (has_parent & has_path[parent_idx] &
+                        (path != expected_path))))
+
+    # most_detailed flags must agree with actual leaves
+    has_children = np.zeros(n_rows, dtype=bool)
+    has_children[parent_idx[has_parent]] = True
+    report('most_detailed',
+           ~is_root & (most_detailed != np.where(has_children, 0, 1)))
+
+    # children of an aggregate must share its cause
+    report('cause_id',
+           has_parent & ~is_root[parent_idx] & ~cause_missing &
+           ~cause_missing[parent_idx] & (cause_id != cause_id[parent_idx]))
+
+    return problems
@@ -0,0 +1,224 @@
+"""
+Command line interface for applying requests to the epic database.
+
+Installed as the ``epic_db_apply`` console script::
+
+    epic_db_apply --conn-def epic --batch-size 500 requests.jsonl
+
+Request files are either JSON, holding a single request dictionary or a list
+of them, or JSONL, holding one request per line. Requests are applied in
+order, in batches that are each committed in their own transaction.
+"""
+from __future__ import print_function
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+
+from epic_db.database import config, session_scope, shares_one_connection
+from epic_db.requests import RequestHandler
+
+CONN_STR_ENV_VAR = 'EPIC_DB_CONN_STR'
+
+
+def read_requests(path):
+    """
+    Read the requests from a JSON or JSONL file.
+
+    Files ending in .jsonl are read one request per line, skipping blank
+    lines. Any other file is read as a single JSON document holding one
+    request dictionary or a list of them.
+
+    Returns:
+        A list of request dictionaries.
+    """
+    with open(path) as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        requests = json.load(f)
+    if isinstance(requests, dict):
+        return [requests]
+    return list(requests)
+
+
+def batch_requests(requests, batch_size):
+    """Split a list of requests into lists of at most batch_size requests."""
+    if batch_size is None or batch_size < 1:
+        return [requests] if requests else []
+    return [requests[i:i + batch_size]
+            for i in range(0, len(requests), batch_size)]
+
+
+def _process_batch(session, batch, journal=False):
+    handler = RequestHandler(session, journal=journal)
+    for request in batch:
+        handler.process_request(request)
+    return len(batch)
+
+
+def apply_batch(batch, dry_run=False, journal=False):
+    """
+    Apply a batch of requests in a single transaction.
+
+    The transaction is committed once every request in the batch has been
+    processed, or rolled back if any of them fails or if dry_run is set.
+    """
+    with session_scope() as session:
+        applied = _process_batch(session, batch, journal=journal)
+        if dry_run:
+            session.rollback()
+    return applied
+
+
+def _check_jobs(jobs):
+    if jobs is not None and jobs > 1 and shares_one_connection(
+            config.engine):
+        raise ValueError(
+            "Can't apply batches concurrently on {}, which has a single "
+            "shared connection; use one job".format(config.engine.url))
+
+
+def apply_requests(requests, batch_size=1000, jobs=1, dry_run=False,
+                   progress=None, journal=False):
+    """
+    Apply requests to the database in batches.
+
+    With a single job, batches are applied in order and the first failing
+    batch stops the run; earlier batches stay committed. A single job dry run
+    processes every batch in one transaction, so later requests can depend on
+    earlier ones, and rolls it back at the end. With more than one job,
+    batches are applied concurrently, so they must not depend on each other,
+    and every batch is attempted.
+
+    Arguments:
+        requests (list): the request dictionaries or JSON strings to apply.
+
+        batch_size (int): the number of requests committed per transaction.
+            None or 0 applies every request in one transaction.
+
+        jobs (int): the number of batches applied at the same time. Must be
+            1 on an engine with a single shared connection, like in-memory
+            sqlite.
+
+        dry_run (bool): process every request but roll back the changes.
+
+        progress (callable): called with (applied, total) after each batch
+            completes.
+
+        journal (bool): record the changes in the change_journal table.
+
+    Raises:
+        ValueError: thrown if jobs is more than 1 and the default engine has a
+            single connection that concurrent batches would share.
+
+    Returns:
+        A list of (batch number, exception) tuples for the failed batches.
+    """
+    _check_jobs(jobs)
+    batches = batch_requests(requests, batch_size)
+    total = len(requests)
+    applied = 0
+    failures = []
+    if jobs is None or jobs <= 1:
+        if dry_run:
+            with session_scope() as session:
+                for i, batch in enumerate(batches):
+                    try:
+                        applied += _process_batch(session, batch,
+                                                  journal=journal)
+                    except Exception as e:
+                        failures.append((i, e))
+                        break
+                    if progress is not None:
+                        progress(applied, total)
+                session.rollback()
+            return failures
+        for i, batch in enumerate(batches):
+            try:
+                applied += apply_batch(batch, journal=journal)
+            except Exception as e:
+                failures.append((i, e))
+                break
+            if progress is not None:
+                progress(applied, total)
+        return failures
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(apply_batch, batch, dry_run, journal)
+                   for batch in batches]
+        for i, future in enumerate(futures):
+            try:
+                applied += future.result()
+            except Exception as e:
+                failures.append((i, e))
+                continue
+            if progress is not None:
+                progress(applied, total)
+    return failures
+
+
+def _print_progress(applied, total):
+    print('applied {} of {} requests'.format(applied, total),
+          file=sys.stderr)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='epic_db_apply',
+        description='Apply JSON or JSONL request files to the epic database.')
+    parser.add_argument('paths', nargs='+', metavar='FILE',
+                        help='request files, applied in the order given')
+    connection = parser.add_mutually_exclusive_group()
+    connection.add_argument(
+        '--conn-str',
+        help='sqlalchemy connection string. Defaults to the {} environment '
+             'variable.'.format(CONN_STR_ENV_VAR))
+    connection.add_argument('--conn-def',
+                            help='db_tools connection definition')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='requests committed per transaction, 0 for one '
+                             'transaction (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='batches applied concurrently. Only use with '
+                             'independent requests (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='process every request, then roll back')
+    parser.add_argument('--journal', action='store_true',
+                        help='record the changes in the change_journal table')
+    parser.add_argument('--progress', action='store_true',
+                        help='report progress to stderr after each batch')
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    conn_str = args.conn_str or os.environ.get(CONN_STR_ENV_VAR)
+    if args.conn_def is not None:
+        config.register_engine(conn_def=args.conn_def)
+    elif conn_str is not None:
+        config.register_engine(conn_str=conn_str)
+
+    try:
+        _check_jobs(args.jobs)
+    except ValueError as e:
+        parser.error(str(e))
+
+    requests = []
+    for path in args.paths:
+        requests.extend(read_requests(path))
+
+    failures = apply_requests(
+        requests, batch_size=args.batch_size, jobs=args.jobs,
+        dry_run=args.dry_run, journal=args.journal,
+        progress=_print_progress if args.progress else None)
+    for i, e in failures:
+        print('batch {} failed: {!r}'.format(i, e), file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
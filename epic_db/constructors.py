@@ -1,5 +1,3 @@
-from gbd.constants import GBD_ROUND_ID
-
 from epic_db import models
 from epic_db.errors import RowNotFoundError
 
@@ -99,7 +97,7 @@ class RowConstructor(object):
                 primary_keys = [
                     col.name for col in model.__mapper__.primary_key]
                 key = tuple(column_map.get(col) for col in primary_keys)
-                this_dep = self.session.query(model).get(key)
+                this_dep = models.get_by_primary_key(self.session, model, key)
             setattr(self, dep, this_dep)
 
     def get_column_names(self):
@@ -131,9 +129,9 @@ class RowConstructor(object):
             raise KeyError(
                 "Primary key {missing} missing from passed primary keys and "
                 "requried for lookup of row from table {table}".format(
-                    missing=missing_pk, table=self.tabelname))
-        pk_ids = [primary_keys[key] for key in self.primary_keys]
-        row = self.session.query(self.model).get(pk_ids)
+                    missing=missing_pk, table=self.tablename))
+        pk_ids = tuple(primary_keys[key] for key in self.primary_keys)
+        row = models.get_by_primary_key(self.session, self.model, pk_ids)
         if row is None:
             raise RowNotFoundError(
                 "Row doesn't exist for composite primary keys: {key_value} "
@@ -237,7 +235,11 @@ class SequelaSetVersionRow(RowConstructor):
 
         insert_cols = {col: column_map.get(col) for col
                        in self.req_insert_cols}
-        gbd_round_id = column_map.get('gbd_round_id', GBD_ROUND_ID)
+        if 'gbd_round_id' in column_map:
+            gbd_round_id = column_map['gbd_round_id']
+        else:
+            from gbd.constants import GBD_ROUND_ID
+            gbd_round_id = GBD_ROUND_ID
         try:
             instance = self.sequela_set.add_version(
                 gbd_round_id=gbd_round_id, **insert_cols)
@@ -1,70 +1,470 @@
+import os
+import threading
+from collections import OrderedDict
 from contextlib import contextmanager
 
 import sqlalchemy as sql
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.expression import Select
 from sqlalchemy.pool import StaticPool
 
+from epic_db.errors import ReadOnlySessionError
+from epic_db.metrics import MeteredQueuePool, PoolMetrics
 from epic_db.models import Base
 
 
+DEFAULT = 'default'
+
+# pool options used for every engine created from a conn_def and every
+# non-sqlite engine created from a url, and the environment variables that
+# override them
+POOL_OPTIONS = {'pool_recycle': 300, 'pool_size': 3, 'max_overflow': 10,
+                'pool_timeout': 120}
+POOL_ENV_VARS = {'pool_recycle': 'EPIC_DB_POOL_RECYCLE',
+                 'pool_size': 'EPIC_DB_POOL_SIZE',
+                 'max_overflow': 'EPIC_DB_MAX_OVERFLOW',
+                 'pool_timeout': 'EPIC_DB_POOL_TIMEOUT'}
+
+# pragmas set on every connection to a file-backed sqlite database. WAL lets
+# readers proceed concurrently with a writer; the rest trade durability on
+# power loss for speed, which is fine for local copies.
+SQLITE_PRAGMAS = OrderedDict([('journal_mode', 'WAL'),
+                              ('synchronous', 'NORMAL'),
+                              ('cache_size', -64000),
+                              ('mmap_size', 268435456),
+                              ('temp_store', 'MEMORY'),
+                              ('busy_timeout', 30000)])
+
 _instances = {}
+_instances_lock = threading.Lock()
+
+# engines inherited from a parent process. References are kept so their
+# pooled connections, which share sockets with the parent, are never closed
+# from the child by garbage collection.
+_inherited_engines = []
+
+
+def add_engine_pidguard(engine):
+    """Invalidate pooled connections that are checked out in a different
+    process than the one that created them, without closing the socket the
+    parent process is still using."""
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.setdefault('pid', pid) != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "Connection record belongs to pid {}, attempting to check "
+                "out in pid {}".format(connection_record.info['pid'], pid))
 
 
 class Config(object):
 
     def __new__(cls, *args, **kw):
         # singleton implementation
-        if not (cls in _instances):
-            instance = super(Config, cls).__new__(cls)
-            _instances[cls] = instance
+        with _instances_lock:
+            if not (cls in _instances):
+                instance = super(Config, cls).__new__(cls)
+                instance._initialized = False
+                _instances[cls] = instance
 
         return _instances[cls]
 
     def __init__(self, engine=None):
-        self.engine = engine
-        self._sessionmaker = None
+        # __init__ runs on every Config() call; only the first call sets up
+        # the registry so later calls don't clobber configured engines
+        if not self._initialized:
+            self._lock = threading.RLock()
+            self._pid = os.getpid()
+            self._factories = {}
+            self._spec_keys = {}
+            self._engines = {}
+            self._sessionmakers = {}
+            self._replicas = {}
+            self._metrics = {}
+            self.pool_options = _pool_options_from_env()
+            self._initialized = True
+        if engine is not None:
+            self.engine = engine
 
     @property
     def engine(self):
-        if self._engine is None:
-            self.create_engine('sqlite://')
-        return self._engine
+        return self.get_engine(DEFAULT)
 
     @engine.setter
     def engine(self, val):
-        self._engine = val
-        if val is not None:
-            self._sessionmaker = sessionmaker(bind=self.engine)
+        if val is None:
+            self.remove_engine(DEFAULT)
         else:
-            self._sessionmaker = None
+            self.register_engine(DEFAULT, engine=val)
 
     @property
     def Session(self):
-        return self._sessionmaker
+        return self.get_sessionmaker(DEFAULT)
+
+    @property
+    def engine_names(self):
+        """Names of all registered engines."""
+        with self._lock:
+            return sorted(set(self._factories) | set(self._engines))
+
+    def configure_pool(self, **options):
+        """
+        Update the pool options used for engines created from a url or a
+        conn_def after this call. Engines that already exist are not
+        affected.
+
+        Arguments:
+            options: any of pool_recycle, pool_size, max_overflow and
+                pool_timeout.
+
+        Raises:
+            ValueError: thrown for unknown pool options.
+        """
+        unknown = [key for key in options if key not in POOL_OPTIONS]
+        if unknown:
+            raise ValueError("Unknown pool options {}, expected any of "
+                             "{}".format(unknown, sorted(POOL_OPTIONS)))
+        with self._lock:
+            self.pool_options.update(options)
+
+    def pool_metrics(self, name=DEFAULT):
+        """Return the PoolMetrics collected for the engine registered under
+        name."""
+        self.get_engine(name)
+        return self._metrics[name]
 
     def create_engine(self, conn_str, *arg, **kwargs):
-        if 'sqlite' in conn_str:
-            engine = sql.create_engine(
-                conn_str, connect_args={'check_same_thread': False},
-                poolclass=StaticPool)
+        """Register conn_str as the default engine, or as the engine called
+        name if given. Keyword arguments are passed to
+        sqlalchemy.create_engine."""
+        name = kwargs.pop('name', DEFAULT)
+        self.register_engine(name, conn_str=conn_str, **kwargs)
+        return self.get_engine(name)
+
+    def register_engine(self, name=DEFAULT, conn_str=None, engine=None,
+                        conn_def=None, replica_of=None, **engine_kwargs):
+        """
+        Register an engine under a name.
+
+        Engines registered by conn_str or conn_def are created lazily on
+        first use, and are recreated in a child process after a fork.
+        Registering the same conn_str or conn_def again under the same name
+        keeps the existing engine.
+
+        Arguments:
+            name (str): the name the engine and its sessionmaker are
+                registered under. Default 'default'.
+
+            conn_str (str): a database url.
+
+            engine (sqlalchemy.engine.Engine): an already created engine.
+
+            conn_def (str): a db_tools connection definition.
+
+            replica_of (str): name of the primary engine this engine is a
+                read replica of. Read-only and routing sessions of the
+                primary send their reads here.
+
+            engine_kwargs: passed to sqlalchemy.create_engine when the engine
+                is created from conn_str.
 
+        Raises:
+            ValueError: thrown unless exactly one of conn_str, engine and
+                conn_def is given.
+        """
+        given = [arg for arg in (conn_str, engine, conn_def)
+                 if arg is not None]
+        if len(given) != 1:
+            raise ValueError(
+                "Exactly one of conn_str, engine or conn_def is required to "
+                "register engine {}".format(name))
+
+        if engine is not None:
+            spec_key = ('engine', id(engine))
+            factory = None
+        elif conn_def is not None:
+            spec_key = ('conn_def', conn_def)
+            factory = _conn_def_factory(conn_def)
         else:
-            engine = sql.create_engine(
-                conn_str, pool_recycle=300, pool_size=3, max_overflow=10,
-                pool_timeout=120)
-        self.engine = engine
+            spec_key = ('conn_str', conn_str,
+                        tuple(sorted(engine_kwargs.items(), key=repr)))
+            factory = _conn_str_factory(conn_str, engine_kwargs)
+
+        with self._lock:
+            self._check_pid()
+            if self._spec_keys.get(name) == spec_key:
+                return
+            self._remove(name)
+            self._spec_keys[name] = spec_key
+            if replica_of is not None:
+                self._replicas[replica_of] = name
+            if factory is not None:
+                self._factories[name] = factory
+            else:
+                self._add_engine(name, engine)
+
+    def remove_engine(self, name):
+        """Remove an engine from the registry, disposing of it if it was
+        created by the registry."""
+        with self._lock:
+            engine = None
+            if name in self._factories:
+                engine = self._engines.get(name)
+            self._remove(name)
+        if engine is not None:
+            engine.dispose()
+
+    def get_engine(self, name=DEFAULT):
+        """
+        Return the engine registered under name, creating it if needed.
+
+        The default engine is an in-memory sqlite database unless another
+        default has been registered.
+
+        Raises:
+            KeyError: thrown if no engine is registered under name.
+        """
+        self._check_pid()
+        engine = self._engines.get(name)
+        if engine is not None:
+            return engine
+
+        with self._lock:
+            if name not in self._engines:
+                if name not in self._factories:
+                    if name != DEFAULT:
+                        raise KeyError("No engine named {}".format(name))
+                    self.register_engine(DEFAULT, conn_str='sqlite://')
+                engine = self._factories[name](dict(self.pool_options))
+                self._add_engine(name, engine)
+            return self._engines[name]
+
+    def get_replica_name(self, name=DEFAULT):
+        """Return the name of the read replica registered for the engine
+        called name, or name itself if it has no replica."""
+        replica = self._replicas.get(name)
+        if replica is None or replica not in self._spec_keys:
+            return name
+        return replica
+
+    def get_sessionmaker(self, name=DEFAULT, read_only=False):
+        """
+        Return the sessionmaker bound to the engine registered under name.
+
+        Arguments:
+            name (str): name of the engine. Default 'default'.
+
+            read_only (bool): if True, the sessions are ReadOnlySessions
+                bound to the engine's read replica, or to the engine itself
+                if it has no replica.
+        """
+        self._check_pid()
+        key = (name, read_only)
+        maker = self._sessionmakers.get(key)
+        if maker is not None:
+            return maker
+
+        with self._lock:
+            if key not in self._sessionmakers:
+                if read_only:
+                    self._sessionmakers[key] = sessionmaker(
+                        bind=self.get_engine(self.get_replica_name(name)),
+                        class_=ReadOnlySession, autoflush=False)
+                else:
+                    self._sessionmakers[key] = sessionmaker(
+                        bind=self.get_engine(name))
+            return self._sessionmakers[key]
+
+    def get_routing_sessionmaker(self, name=DEFAULT):
+        """Return a sessionmaker of RoutingSessions that read from the read
+        replica of the engine called name and write to the engine itself."""
+        return sessionmaker(class_=RoutingSession, primary=name)
+
+    def _add_engine(self, name, engine):
+        _add_fork_guard(engine)
+        self._metrics[name] = PoolMetrics()
+        self._metrics[name].attach(engine)
+        self._engines[name] = engine
+
+    def _remove(self, name):
+        self._metrics.pop(name, None)
+        self._factories.pop(name, None)
+        self._spec_keys.pop(name, None)
+        self._engines.pop(name, None)
+        self._replicas = {primary: replica for primary, replica
+                          in self._replicas.items() if replica != name}
+        # read-only sessionmakers of other names may be bound to this engine
+        self._sessionmakers.clear()
+
+    def _check_pid(self):
+        """After a fork, drop every engine that can be recreated so the child
+        process builds its own pool instead of sharing the parent's
+        sockets."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            for name in list(self._engines):
+                if (name in self._factories and
+                        not _is_memory_sqlite(self._engines[name])):
+                    _inherited_engines.append(self._engines.pop(name))
+            self._sessionmakers.clear()
+            self._pid = os.getpid()
+
+
+class ReadOnlySession(Session):
+    """A session that refuses to flush changes to the database."""
+
+    def flush(self, objects=None):
+        if self.new or self.dirty or self.deleted:
+            raise ReadOnlySessionError(
+                "Cannot flush changes from a read-only session")
+        super(ReadOnlySession, self).flush(objects)
+
+
+class RoutingSession(Session):
+
+    def __init__(self, primary=DEFAULT, **kwargs):
+        """
+        A session that sends reads to a read replica and writes to the
+        primary engine.
+
+        Only SELECT constructs count as reads; any other statement,
+        including text() and plain strings, is sent to the primary. Once the
+        session has written anything, every following statement goes to the
+        primary so the session always reads its own writes.
+
+        Arguments:
+            primary (str): name of the primary engine in the config
+                registry. Reads go to its registered replica, if any.
+        """
+        super(RoutingSession, self).__init__(**kwargs)
+        self.primary = primary
+        self.has_written = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if clause is not None and not isinstance(clause, Select):
+            self.has_written = True
+        if self._flushing or self.has_written:
+            return config.get_engine(self.primary)
+        return config.get_engine(config.get_replica_name(self.primary))
+
+    def flush(self, objects=None):
+        if self.new or self.dirty or self.deleted:
+            self.has_written = True
+        super(RoutingSession, self).flush(objects)
+
+
+def shares_one_connection(bind):
+    """Return True if every session on bind uses the same DBAPI connection,
+    as with a Connection or an engine on a StaticPool like the default
+    in-memory sqlite database. Work on such a bind can't be spread over
+    threads."""
+    if isinstance(bind, sql.engine.Connection):
+        return True
+    return isinstance(bind.pool, StaticPool) or _is_memory_sqlite(bind)
+
+
+def _is_memory_sqlite(engine):
+    return _is_memory_sqlite_url(engine.url)
+
+
+def _is_memory_sqlite_url(url):
+    return (url.drivername.startswith('sqlite') and
+            url.database in (None, '', ':memory:'))
+
+
+def set_sqlite_pragmas(engine, pragmas=None):
+    """Set pragmas on every new connection of a sqlite engine. Default
+    SQLITE_PRAGMAS."""
+    if pragmas is None:
+        pragmas = SQLITE_PRAGMAS
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+        cursor.close()
+
+
+def _add_fork_guard(engine):
+    # an in-memory sqlite database lives in the process; the child's copy of
+    # the connection is its only way to reach the data
+    if not _is_memory_sqlite(engine):
+        add_engine_pidguard(engine)
+
+
+def _pool_options_from_env():
+    options = dict(POOL_OPTIONS)
+    for key, env_var in POOL_ENV_VARS.items():
+        if os.environ.get(env_var):
+            options[key] = int(os.environ[env_var])
+    return options
+
+
+def _conn_str_factory(conn_str, engine_kwargs):
+
+    def factory(pool_options):
+        url = make_url(conn_str)
+        kwargs = dict(engine_kwargs)
+        pragmas = kwargs.pop('sqlite_pragmas', None)
+        if _is_memory_sqlite_url(url):
+            kwargs = dict({'connect_args': {'check_same_thread': False},
+                           'poolclass': StaticPool}, **kwargs)
+            return sql.create_engine(url, **kwargs)
+
+        kwargs = dict(dict(pool_options, poolclass=MeteredQueuePool),
+                      **kwargs)
+        if url.drivername.startswith('sqlite'):
+            kwargs.setdefault('connect_args', {'check_same_thread': False})
+            engine = sql.create_engine(url, **kwargs)
+            set_sqlite_pragmas(engine, pragmas)
+            return engine
+        return sql.create_engine(url, **kwargs)
+
+    return factory
+
+
+def _conn_def_factory(conn_def):
+
+    def factory(pool_options):
+        from db_tools.ezfuncs import get_engine
+        # db_tools doesn't take pool options, so only its url is kept and
+        # the engine is rebuilt with the configured, metered pool
+        db_tools_engine = get_engine(conn_def=conn_def)
+        url = db_tools_engine.url
+        db_tools_engine.dispose()
+        return sql.create_engine(
+            url, **dict(pool_options, poolclass=MeteredQueuePool))
+
+    return factory
 
 
 config = Config()
 
 
 @contextmanager
-def session_scope():
-    """Provide a transactional scope around a series of operations."""
-    session = config.Session()
+def session_scope(name=DEFAULT, read_only=False):
+    """Provide a transactional scope around a series of operations. Read-only
+    scopes use the engine's read replica, if registered, and are rolled back
+    instead of committed."""
+    session = config.get_sessionmaker(name, read_only=read_only)()
     try:
         yield session
-        session.commit()
+        if read_only:
+            session.rollback()
+        else:
+            session.commit()
     except Exception:
         session.rollback()
         raise
@@ -78,6 +478,90 @@ def create_db():
     return True
 
 
+def create_missing_indexes(engine=None):
+    """
+    Add the indexes declared in the models that are missing from an existing
+    database. Tables that don't exist yet are skipped.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): the database to migrate. Default
+            None uses the default engine.
+
+    Returns:
+        A list of the names of the indexes created.
+    """
+    if engine is None:
+        engine = config.engine
+    inspector = sql.inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in
+                       inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+
+def create_missing_defaults(engine=None):
+    """
+    Add the server defaults declared in the models, such as the UTC audit
+    timestamps rows inserted through Core rely on, to the columns of an
+    existing database that have no default. Tables that don't exist yet are
+    skipped.
+
+    On MySQL the defaults are UTC_TIMESTAMP() expressions, which column
+    defaults only accept from MySQL 8.0.13 on.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine): the database to migrate. Default
+            None uses the default engine.
+
+    Raises:
+        NotImplementedError: thrown if a sqlite column is missing a default,
+            since sqlite can't alter an existing column.
+
+    Returns:
+        A list of the 'table.column' names whose default was added.
+    """
+    if engine is None:
+        engine = config.engine
+    inspector = sql.inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        defaults = {column['name']: column.get('default') for column in
+                    inspector.get_columns(table.name)}
+        for column in table.columns:
+            if (column.server_default is None or
+                    column.name not in defaults or
+                    defaults[column.name] is not None):
+                continue
+            if engine.dialect.name == 'sqlite':
+                raise NotImplementedError(
+                    "sqlite can't add a default to existing column "
+                    "{}.{}".format(table.name, column.name))
+            engine.execute(_set_default_statement(column, engine.dialect))
+            created.append('{}.{}'.format(table.name, column.name))
+    return created
+
+
+def _set_default_statement(column, dialect):
+    preparer = dialect.identifier_preparer
+    return 'ALTER TABLE {} ALTER COLUMN {} SET DEFAULT {}'.format(
+        preparer.format_table(column.table),
+        preparer.format_column(column),
+        column.server_default.arg.compile(dialect=dialect))
+
+
 def delete_db():
     """create sqlite database from models schema"""
     Base.metadata.drop_all(config.engine)  # doesn't create if exists
@@ -8,6 +8,24 @@ class RowNotFoundError(BaseEpicDbError):
     created."""
 
 
+class ReadOnlySessionError(BaseEpicDbError):
+    """Changes were flushed from a session opened for reading only."""
+
+
 class SequelaSetVersionValidationError(BaseEpicDbError):
     """The sequela_set_version in question failed the validations necessary
-    for activation"""
+    for activation. When raised after running several validators, failures
+    maps each failed validator's name to the error it raised."""
+
+    def __init__(self, message, failures=None):
+        super(SequelaSetVersionValidationError, self).__init__(message)
+        self.failures = failures or {}
+
+
+class RequestValidationError(BaseEpicDbError, ValueError):
+    """The request is malformed and was rejected before touching the
+    database. errors lists a (path, message) tuple for every problem."""
+
+    def __init__(self, message, errors=None):
+        super(RequestValidationError, self).__init__(message)
+        self.errors = errors or []
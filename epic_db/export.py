@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+
+import sqlalchemy as sql
+
+from epic_db.database import session_scope
+from epic_db.models import (SequelaSetVersion,
+                            SequelaSetVersionActive,
+                            SequelaHierarchyHistory,
+                            SequelaReiHistory)
+
+MANIFEST_NAME = 'manifest.json'
+
+HIERARCHY_EXPORT_COLUMNS = ['sequela_set_version_id', 'sequela_set_id',
+                            'sequela_id', 'level', 'most_detailed',
+                            'parent_id', 'path_to_top_parent', 'sort_order',
+                            'sequela_name', 'modelable_entity_id', 'cause_id',
+                            'healthstate_id']
+REI_EXPORT_COLUMNS = ['sequela_set_version_id', 'sequela_id', 'rei_id']
+
+_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+
+def export_version(sequela_set_version_id, directory, file_format='parquet',
+                   batch_size=10000, session=None):
+    """
+    Write the hierarchy and rei mappings of a version to columnar files.
+
+    Rows are streamed from the database with a server-side cursor and
+    written batch by batch, so memory use is bounded by batch_size. Each
+    table is written to its own file named after the version and a
+    fingerprint of its content, and the version's entry in the directory's
+    manifest is updated.
+
+    Arguments:
+        sequela_set_version_id (int): the version to export.
+
+        directory (str): directory to write the files and manifest to.
+            Created if it doesn't exist.
+
+        file_format (str): 'parquet' or 'arrow' (Arrow IPC file format).
+            Default 'parquet'.
+
+        batch_size (int): number of rows fetched and written at a time.
+
+        session (sqlalchemy.orm.Session): session to read with. Default None
+            opens a new read-only session.
+
+    Returns:
+        The manifest entry for this version.
+    """
+    if session is None:
+        with session_scope(read_only=True) as session:
+            return export_version(sequela_set_version_id, directory,
+                                  file_format=file_format,
+                                  batch_size=batch_size, session=session)
+
+    entry = _export_version(session, sequela_set_version_id, directory,
+                            file_format, batch_size)
+    _update_manifest(directory, {sequela_set_version_id: entry})
+    return entry
+
+
+def export_active_versions(gbd_round_id, directory, file_format='parquet',
+                           batch_size=10000, session=None):
+    """
+    Export every active version for a gbd_round_id.
+
+    Arguments:
+        gbd_round_id (int): the round whose active versions are exported.
+
+        directory (str): directory to write the files and manifest to.
+
+        file_format (str): 'parquet' or 'arrow'. Default 'parquet'.
+
+        batch_size (int): number of rows fetched and written at a time.
+
+        session (sqlalchemy.orm.Session): session to read with. Default None
+            opens a new read-only session.
+
+    Returns:
+        A dict mapping each exported sequela_set_version_id to its manifest
+            entry.
+    """
+    if session is None:
+        with session_scope(read_only=True) as session:
+            return export_active_versions(gbd_round_id, directory,
+                                          file_format=file_format,
+                                          batch_size=batch_size,
+                                          session=session)
+
+    version_ids = [row.sequela_set_version_id for row in session.query(
+        SequelaSetVersionActive.sequela_set_version_id).filter(
+        SequelaSetVersionActive.gbd_round_id == gbd_round_id).order_by(
+        SequelaSetVersionActive.sequela_set_id)]
+
+    entries = {}
+    for version_id in version_ids:
+        entries[version_id] = _export_version(
+            session, version_id, directory, file_format, batch_size)
+        entries[version_id]['gbd_round_id'] = gbd_round_id
+    _update_manifest(directory, entries)
+    return entries
+
+
+def read_manifest(directory):
+    """Return the manifest of an export directory, keyed by
+    sequela_set_version_id. Empty if nothing has been exported yet."""
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {int(key): value for key, value in json.load(f).items()}
+
+
+def _export_version(session, sequela_set_version_id, directory, file_format,
+                    batch_size):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError("pyarrow is required to export sequela versions")
+    if file_format not in _EXTENSIONS:
+        raise ValueError("file_format must be one of {}, got {}".format(
+            sorted(_EXTENSIONS), file_format))
+
+    version = session.query(SequelaSetVersion).get(sequela_set_version_id)
+    if not version:
+        raise ValueError(
+            "Sequela_set_version_id {} not found in "
+            "epic.sequela_set_version table.".format(sequela_set_version_id))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fingerprint = hashlib.sha1()
+    files = {}
+    row_counts = {}
+    for model, columns in [(SequelaHierarchyHistory,
+                            HIERARCHY_EXPORT_COLUMNS),
+                           (SequelaReiHistory, REI_EXPORT_COLUMNS)]:
+        tablename = model.__tablename__
+        fingerprint.update(tablename.encode())
+        stmt = sql.select(
+            [model.__table__.c[col] for col in columns]).where(
+            model.sequela_set_version_id == sequela_set_version_id).order_by(
+            *model.__table__.primary_key.columns)
+        tmp_path = os.path.join(directory, '.{}_{}.tmp'.format(
+            tablename, sequela_set_version_id))
+        row_counts[tablename] = _write_table(
+            session, stmt, model, columns, tmp_path, file_format,
+            batch_size, fingerprint)
+        files[tablename] = tmp_path
+
+    digest = fingerprint.hexdigest()
+    for tablename, tmp_path in list(files.items()):
+        filename = '{}_{}_{}.{}'.format(
+            tablename, sequela_set_version_id, digest[:12],
+            _EXTENSIONS[file_format])
+        os.rename(tmp_path, os.path.join(directory, filename))
+        files[tablename] = filename
+
+    return {'sequela_set_id': version.sequela_set_id,
+            'gbd_round_id': version.gbd_round_id,
+            'fingerprint': digest,
+            'format': file_format,
+            'files': files,
+            'row_counts': row_counts}
+
+
+def _arrow_schema(model, columns):
+    import pyarrow as pa
+
+    types = {sql.Integer: pa.int64(), sql.Float: pa.float64(),
+             sql.String: pa.string()}
+    fields = []
+    for col in columns:
+        col_type = model.__table__.c[col].type
+        arrow_type = next(arrow_type for sql_type, arrow_type in types.items()
+                          if isinstance(col_type, sql_type))
+        fields.append(pa.field(col, arrow_type))
+    return pa.schema(fields)
+
+
+def _write_table(session, stmt, model, columns, path, file_format,
+                 batch_size, fingerprint):
+    """Stream the statement's rows into a columnar file, updating the
+    fingerprint with every row. Returns the number of rows written."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema(model, columns)
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.RecordBatchFileWriter(path, schema)
+
+    n_rows = 0
+    try:
+        result = session.connection().execution_options(
+            stream_results=True).execute(stmt)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            n_rows += len(rows)
+            for row in rows:
+                fingerprint.update(repr(tuple(row)).encode())
+            arrays = [pa.array(list(values), type=field.type)
+                      for values, field in zip(zip(*rows), schema)]
+            batch = pa.RecordBatch.from_arrays(arrays, columns)
+            if file_format == 'parquet':
+                writer.write_table(pa.Table.from_batches([batch]))
+            else:
+                writer.write_batch(batch)
+        result.close()
+    finally:
+        writer.close()
+    return n_rows
+
+
+def _update_manifest(directory, entries):
+    manifest = read_manifest(directory)
+    manifest.update(entries)
+    path = os.path.join(directory, MANIFEST_NAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({str(key): manifest[key] for key in sorted(manifest)}, f,
+                  indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
@@ -0,0 +1,216 @@
+"""
+Append-only change journal.
+
+While a session is journaled (see journaled()), every row the session inserts,
+updates or deletes is recorded in the change_journal table in the same
+transaction: the table, the primary key, and the column values before and
+after the change. Inserts record every column after the change, deletes every
+column before it, and updates only the columns that changed.
+
+The journal is read back in order with read_journal() and applied to another
+database with replay_journal(), which makes it cheap to keep read caches and
+snapshots up to date or to rebuild a database from an empty schema.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+import json
+
+from sqlalchemy import DateTime, and_, event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from epic_db.models import Base, ChangeJournal
+
+JOURNAL_KEY = 'journal_request_id'
+INSERT = 'INSERT'
+UPDATE = 'UPDATE'
+DELETE = 'DELETE'
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+@contextmanager
+def journaled(session, request_id=None):
+    """
+    Record the changes flushed by session inside the block in the journal.
+
+    Arguments:
+        session (sqlalchemy.orm.Session)
+
+        request_id (str): stored with every journal entry. Default None.
+    """
+    previous = session.info.get(JOURNAL_KEY, False)
+    session.info[JOURNAL_KEY] = request_id
+    try:
+        yield
+    finally:
+        if previous is False:
+            del session.info[JOURNAL_KEY]
+        else:
+            session.info[JOURNAL_KEY] = previous
+
+
+def _dumps(values):
+    if values is None:
+        return None
+    return json.dumps(values, sort_keys=True, default=_encode)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def _column_values(instance, columns):
+    return {column.name: getattr(instance, prop.key)
+            for prop, column in columns}
+
+
+def _entry(request_id, instance, operation, before=None, after=None):
+    mapper = inspect(instance).mapper
+    primary_key = {column.name: value for column, value in
+                   zip(mapper.primary_key,
+                       mapper.primary_key_from_instance(instance))}
+    return {'request_id': request_id,
+            'tablename': mapper.local_table.name,
+            'operation': operation,
+            'primary_key': _dumps(primary_key),
+            'before_values': _dumps(before),
+            'after_values': _dumps(after)}
+
+
+def _mapped_columns(instance):
+    mapper = inspect(instance).mapper
+    return [(mapper.get_property_by_column(column), column)
+            for column in mapper.local_table.columns]
+
+
+@event.listens_for(Session, 'after_flush')
+def _journal_flush(session, flush_context):
+    if JOURNAL_KEY not in session.info:
+        return
+    request_id = session.info[JOURNAL_KEY]
+    entries = []
+    for instance in session.new:
+        if isinstance(instance, ChangeJournal):
+            continue
+        after = _column_values(instance, _mapped_columns(instance))
+        entries.append(_entry(request_id, instance, INSERT, after=after))
+    for instance in session.dirty:
+        before, after = {}, {}
+        for prop, column in _mapped_columns(instance):
+            history = get_history(instance, prop.key)
+            if not history.added and not history.deleted:
+                continue
+            before[column.name] = (history.deleted[0] if history.deleted
+                                   else None)
+            after[column.name] = history.added[0] if history.added else None
+        if after:
+            entries.append(_entry(request_id, instance, UPDATE,
+                                  before=before, after=after))
+    for instance in session.deleted:
+        before = _column_values(instance, _mapped_columns(instance))
+        entries.append(_entry(request_id, instance, DELETE, before=before))
+
+    if entries:
+        # inserts and updates go parents first and deletes children first, so
+        # a replay satisfies foreign keys
+        order = {table.name: i for i, table in
+                 enumerate(Base.metadata.sorted_tables)}
+        entries.sort(key=lambda entry: (
+            (1, -order[entry['tablename']]) if entry['operation'] == DELETE
+            else (0, order[entry['tablename']])))
+        session.execute(ChangeJournal.__table__.insert(), entries)
+
+
+def read_journal(session, after_journal_id=None, request_id=None):
+    """
+    Return journal entries in the order they were recorded.
+
+    Arguments:
+        session (sqlalchemy.orm.Session)
+
+        after_journal_id (int): only return entries recorded after this one,
+            e.g. the last entry replayed. Default None returns every entry.
+
+        request_id (str): only return the entries of one request.
+
+    Returns:
+        A list of ChangeJournal rows.
+    """
+    query = session.query(ChangeJournal)
+    if after_journal_id is not None:
+        query = query.filter(ChangeJournal.journal_id > after_journal_id)
+    if request_id is not None:
+        query = query.filter(ChangeJournal.request_id == request_id)
+    return query.order_by(ChangeJournal.journal_id).all()
+
+
+def _decode(table, values):
+    decoded = {}
+    for name, value in json.loads(values).items():
+        if value is not None and isinstance(table.c[name].type, DateTime):
+            value = _parse_datetime(value)
+        decoded[name] = value
+    return decoded
+
+
+def _parse_datetime(value):
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Unrecognized journal timestamp {!r}".format(value))
+
+
+def _where_primary_key(table, primary_key):
+    return and_(*[table.c[name] == value
+                  for name, value in primary_key.items()])
+
+
+def replay_journal(entries, session):
+    """
+    Apply journal entries to the database session is bound to.
+
+    Runs of inserts into the same table are executed as a single
+    executemany. The caller commits.
+
+    Arguments:
+        entries (list): ChangeJournal rows, e.g. from read_journal(), in the
+            order they were recorded.
+
+        session (sqlalchemy.orm.Session): a session on the database to
+            update. Replayed changes are not journaled again.
+
+    Returns:
+        The journal_id of the last entry applied, or None if there were no
+            entries. Pass it as after_journal_id to read the next entries.
+    """
+    tables = Base.metadata.tables
+    pending_table, pending_rows = None, []
+    last_id = None
+    for entry in entries:
+        table = tables[entry.tablename]
+        if pending_rows and (entry.operation != INSERT or
+                             table is not pending_table):
+            session.execute(pending_table.insert(), pending_rows)
+            pending_rows = []
+        if entry.operation == INSERT:
+            pending_table = table
+            pending_rows.append(_decode(table, entry.after_values))
+        elif entry.operation == UPDATE:
+            session.execute(table.update().where(_where_primary_key(
+                table, json.loads(entry.primary_key))).values(
+                _decode(table, entry.after_values)))
+        elif entry.operation == DELETE:
+            session.execute(table.delete().where(_where_primary_key(
+                table, json.loads(entry.primary_key))))
+        else:
+            raise ValueError(
+                "Unknown journal operation {!r} in entry {}".format(
+                    entry.operation, entry.journal_id))
+        last_id = entry.journal_id
+    if pending_rows:
+        session.execute(pending_table.insert(), pending_rows)
+    return last_id
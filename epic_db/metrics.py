@@ -0,0 +1,180 @@
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+# upper bounds, in seconds, of the checkout wait time histogram buckets
+WAIT_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60,
+                     120)
+
+
+class PoolMetrics(object):
+
+    def __init__(self, buckets=WAIT_TIME_BUCKETS):
+        """
+        Connection pool usage collected from pool events.
+
+        Checkout counts come from the checkout and checkin events of any
+        pool. Wait times and checkout timeouts are only recorded for engines
+        using a MeteredQueuePool.
+
+        Arguments:
+            buckets (float list): upper bounds, in seconds, of the wait time
+                histogram buckets. A final unbounded bucket is always added.
+        """
+        self._lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets))
+        self.pool = None
+        self.reset()
+
+    def reset(self):
+        """Zero every counter."""
+        with self._lock:
+            self.connections = 0
+            self.checkouts = 0
+            self.checked_out = 0
+            self.peak_checked_out = 0
+            self.invalidated = 0
+            self.checkout_timeouts = 0
+            self.wait_time_total = 0.
+            self.wait_time_max = 0.
+            self.wait_time_counts = [0] * (len(self.buckets) + 1)
+
+    def attach(self, engine):
+        """Start collecting metrics from an engine's pool."""
+        self.pool = engine.pool
+        if isinstance(engine.pool, MeteredQueuePool):
+            engine.pool.metrics = self
+
+        @event.listens_for(engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            with self._lock:
+                self.connections += 1
+
+        @event.listens_for(engine, 'checkout')
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            with self._lock:
+                self.checkouts += 1
+                self.checked_out += 1
+                self.peak_checked_out = max(self.peak_checked_out,
+                                            self.checked_out)
+
+        @event.listens_for(engine, 'checkin')
+        def checkin(dbapi_connection, connection_record):
+            with self._lock:
+                self.checked_out -= 1
+
+        @event.listens_for(engine, 'invalidate')
+        def invalidate(dbapi_connection, connection_record, exception):
+            with self._lock:
+                self.invalidated += 1
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_time_total += seconds
+            self.wait_time_max = max(self.wait_time_max, seconds)
+            self.wait_time_counts[bisect_left(self.buckets, seconds)] += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.checkout_timeouts += 1
+
+    def snapshot(self):
+        """
+        Return the current metrics.
+
+        Returns:
+            A dict of counters. wait_time_histogram maps each bucket's upper
+                bound (None for the unbounded bucket) to the number of
+                checkouts that waited that long. overflow and pool_size are
+                only reported for queue pools.
+        """
+        with self._lock:
+            metrics = {
+                'connections': self.connections,
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'invalidated': self.invalidated,
+                'checkout_timeouts': self.checkout_timeouts,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+                'wait_time_histogram': list(zip(
+                    self.buckets + (None,), self.wait_time_counts))}
+        if isinstance(self.pool, QueuePool):
+            metrics['overflow'] = self.pool.overflow()
+            metrics['pool_size'] = self.pool.size()
+        return metrics
+
+
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that reports how long each checkout waited for a
+    connection, including the time to open a new one, and how many
+    checkouts timed out."""
+
+    metrics = None
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            connection = super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            if self.metrics is not None:
+                self.metrics.record_timeout()
+            raise
+        if self.metrics is not None:
+            self.metrics.record_wait(time.time() - start)
+        return connection
+
+    def recreate(self):
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.metrics = self.metrics
+        if self.metrics is not None:
+            self.metrics.pool = pool
+        return pool
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        """
+        Count the SQL statements an engine executes inside a with block.
+
+        Each cursor execution counts once, so an executemany of many rows is
+        a single statement. Statements executed from any thread or session
+        bound to the engine are counted.
+
+        Arguments:
+            engine (sqlalchemy.engine.Engine): the engine to listen to.
+
+        Example:
+            with QueryCounter(config.engine) as counter:
+                handler.process_request(request)
+            assert counter.count <= 20
+        """
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        with self._lock:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        return False
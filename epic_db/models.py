@@ -4,12 +4,21 @@ from sqlalchemy import (Column,
                         Float,
                         ForeignKey,
                         String,
-                        ForeignKeyConstraint)
+                        Text,
+                        ForeignKeyConstraint,
+                        Index,
+                        bindparam,
+                        event)
+from sqlalchemy.ext import baked
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import Session, object_session, relationship
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.sql.expression import FunctionElement
 
 from datetime import datetime
-from numpy import atleast_1d
+
+from epic_db.profiling import profiled
 
 
 class Base(object):
@@ -19,7 +28,7 @@ class Base(object):
         if columns is None:
             return wired
         else:
-            columns = list(atleast_1d(columns))
+            columns = [columns] if isinstance(columns, str) else list(columns)
 
         if exclude_columns:
             return {key: wired[key] for key in wired if key not in columns}
@@ -30,16 +39,117 @@ class Base(object):
 Base = declarative_base(cls=Base)
 
 
+class utc_timestamp(FunctionElement):
+    """The current UTC time on the database server. MySQL's CURRENT_TIMESTAMP
+    is in the connection's time zone, so it would disagree with the UTC
+    timestamps the ORM writes."""
+    type = DateTime()
+    name = 'utc_timestamp'
+
+
+@compiles(utc_timestamp)
+def _compile_utc_timestamp(element, compiler, **kw):
+    # sqlite's CURRENT_TIMESTAMP is always UTC
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(utc_timestamp, 'mysql')
+def _compile_mysql_utc_timestamp(element, compiler, **kw):
+    # parenthesized to be valid as a column default, which needs MySQL 8.0.13
+    return '(UTC_TIMESTAMP())'
+
+
+# audit columns the ORM stamps with the transaction timestamp on insert. The
+# database fills them from their UTC server defaults for rows inserted
+# through Core, so bulk inserts send no per-row python values. Databases
+# created before the defaults existed get them from create_missing_defaults.
+AUDIT_TIMESTAMP_COLUMNS = ('active_start', 'start_date', 'date_inserted',
+                           'last_updated')
+TIMESTAMP_KEY = 'transaction_timestamp'
+
+
+def transaction_timestamp(session=None):
+    """
+    Return the UTC timestamp shared by every row written in the session's
+    current transaction.
+
+    The timestamp is taken the first time it's needed in a transaction and
+    dropped when the outermost transaction ends.
+
+    Arguments:
+        session (sqlalchemy.orm.Session): Default None returns the current
+            time.
+    """
+    if session is None:
+        return datetime.utcnow()
+    if TIMESTAMP_KEY not in session.info:
+        session.info[TIMESTAMP_KEY] = datetime.utcnow()
+    return session.info[TIMESTAMP_KEY]
+
+
+@event.listens_for(Session, 'before_flush')
+def _stamp_audit_columns(session, flush_context, instances):
+    """Fill the unset audit timestamps of new rows and set last_updated on
+    modified rows, all to the transaction timestamp. Rows updated through
+    Core get last_updated from its server side onupdate instead."""
+    if not session.new and not session.dirty:
+        return
+    now = transaction_timestamp(session)
+    for instance in session.new:
+        columns = instance.__table__.c
+        for name in AUDIT_TIMESTAMP_COLUMNS:
+            if name in columns and getattr(instance, name) is None:
+                setattr(instance, name, now)
+    for instance in session.dirty:
+        if ('last_updated' in instance.__table__.c and
+                session.is_modified(instance, include_collections=False)):
+            instance.last_updated = now
+            # keep the column in the UPDATE even when the value is unchanged
+            # so its server side onupdate never overrides the timestamp
+            flag_modified(instance, 'last_updated')
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _clear_transaction_timestamp(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(TIMESTAMP_KEY, None)
+
+
+# cache of compiled lookup queries; the model is always passed as a cache key
+# argument since lambdas sharing code but closing over different models would
+# otherwise share a cache entry
+bakery = baked.bakery()
+
+
+def get_by_primary_key(session, model, ident):
+    """
+    Return the row of model with primary key ident, or None.
+
+    Equivalent to session.query(model).get(ident) but the lookup query is
+    compiled once per model and cached.
+
+    Arguments:
+        session (sqlalchemy.orm.Session): the session to load the row with.
+
+        model (Base subclass): the model to query.
+
+        ident (scalar, tuple or list): the primary key value(s).
+    """
+    return bakery(
+        lambda session: session.query(model), model)(session).get(ident)
+
+
 class Sequela(Base):
     __tablename__ = 'sequela'
 
     sequela_id = Column(Integer, primary_key=True)
     sequela_name = Column(String(255), unique=True)
-    active_start = Column(DateTime, default=datetime.utcnow)
+    active_start = Column(DateTime, server_default=utc_timestamp())
     active_end = Column(DateTime, None)
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -64,7 +174,7 @@ class Sequela(Base):
 
     def delete(self):
         """Mark a Sequela row as deprecated."""
-        self.active_end = datetime.utcnow()
+        self.active_end = transaction_timestamp(object_session(self))
         self.last_updated_action = 'DELETE'
 
 
@@ -74,9 +184,10 @@ class SequelaSet(Base):
     sequela_set_id = Column(Integer, primary_key=True)
     sequela_set_name = Column(String(175), default=None, unique=True)
     sequela_set_description = Column(String(500), default=None)
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -97,6 +208,7 @@ class SequelaSet(Base):
                     self.last_updated_by,
                     self.last_updated_action))
 
+    @profiled('SequelaSet.add_version')
     def add_version(self, sequela_set_version=None,
                     sequela_set_version_description=None,
                     sequela_set_version_justification=None,
@@ -128,6 +240,7 @@ class SequelaSet(Base):
 
         return row
 
+    @profiled('SequelaSet.backfill_version')
     def backfill_version(self, old_version_id, new_version_id):
         old_version = self.fk_sequela_set_version_id.filter(
             SequelaSetVersion.sequela_set_version_id == old_version_id).one()
@@ -153,16 +266,18 @@ class SequelaSetVersion(Base):
     sequela_set_version_id = Column(Integer, primary_key=True)
     sequela_set_id = Column(
         Integer,
-        ForeignKey('sequela_set.sequela_set_id'))
+        ForeignKey('sequela_set.sequela_set_id'),
+        index=True)
     sequela_set_version = Column(String(255), default=None)
     sequela_set_version_description = Column(String(500), default=None)
     sequela_set_version_justification = Column(String(500), default=None)
     gbd_round_id = Column(Integer, default=None)
-    start_date = Column(DateTime, default=datetime.utcnow)
+    start_date = Column(DateTime, server_default=utc_timestamp())
     end_date = Column(DateTime, default=None)
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -206,7 +321,7 @@ class SequelaSetVersion(Base):
 
     def delete(self):
         """Mark SequelaSetVersion as deprecated."""
-        self.end_date = datetime.utcnow()
+        self.end_date = transaction_timestamp(object_session(self))
         self.last_updated_action = 'DELETE'
 
     def hierarchy_add_most_detailed(self, sequela, cause_id=None,
@@ -257,8 +372,22 @@ class SequelaSetVersion(Base):
             sequela_ids = sequela_id
         else:
             sequela_ids = [sequela_id]
-        return self.fk_sequela_hierarchy_history.filter(
-            SequelaHierarchyHistory.sequela_id.in_(sequela_ids)).all()
+
+        session = object_session(self)
+        if self.sequela_set_version_id is None:
+            # a pending version only gets its id when flushed, and the id is
+            # bound before the query's own autoflush runs
+            session.flush()
+
+        query = bakery(lambda session: session.query(SequelaHierarchyHistory))
+        query += lambda q: q.filter(
+            SequelaHierarchyHistory.sequela_set_version_id ==
+            bindparam('sequela_set_version_id'),
+            SequelaHierarchyHistory.sequela_id.in_(
+                bindparam('sequela_ids', expanding=True)))
+        return query(session).params(
+            sequela_set_version_id=self.sequela_set_version_id,
+            sequela_ids=sequela_ids).all()
 
     def get_child_rows(self, parent_id):
         """
@@ -442,9 +571,10 @@ class SequelaSetVersionActive(Base):
     sequela_set_version_id = Column(
         Integer,
         ForeignKey('sequela_set_version.sequela_set_version_id'))
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -474,7 +604,11 @@ class SequelaHierarchyHistory(Base):
         ForeignKeyConstraint(
             ['sequela_set_version_id', 'parent_id'],
             ['sequela_hierarchy_history.sequela_set_version_id',
-             'sequela_hierarchy_history.sequela_id']),)
+             'sequela_hierarchy_history.sequela_id']),
+        Index('ix_sequela_hierarchy_history_parent_id',
+              'sequela_set_version_id', 'parent_id'),
+        Index('ix_sequela_hierarchy_history_most_detailed',
+              'sequela_set_version_id', 'most_detailed'))
 
     sequela_set_version_id = Column(
         Integer,
@@ -494,14 +628,15 @@ class SequelaHierarchyHistory(Base):
     sort_order = Column(Float, default=0)
     sequela_name = Column(String(175))
     # lancet_label = Column(String(200), default=None)
-    modelable_entity_id = Column(Integer, default=None)
-    cause_id = Column(Integer, default=None)
-    healthstate_id = Column(Integer, default=None)
-    start_date = Column(DateTime, default=datetime.utcnow)
+    modelable_entity_id = Column(Integer, default=None, index=True)
+    cause_id = Column(Integer, default=None, index=True)
+    healthstate_id = Column(Integer, default=None, index=True)
+    start_date = Column(DateTime, server_default=utc_timestamp())
     end_date = Column(DateTime, default=None)
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -583,10 +718,11 @@ class SequelaReiHistory(Base):
     sequela_id = Column(
         Integer, ForeignKey('sequela.sequela_id'),
         primary_key=True)
-    rei_id = Column(Integer, primary_key=True)
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    rei_id = Column(Integer, primary_key=True, index=True)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -624,9 +760,10 @@ class Healthstate(Base):
     healthstate_type_id = Column(
         Integer,
         ForeignKey('healthstate_type.healthstate_type_id'))
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -659,9 +796,10 @@ class HealthstateType(Base):
     healthstate_type_id = Column(Integer, primary_key=True)
     healthstate_type = Column(String(64))
     healthstate_type_description = Column(String(500), default=None)
-    date_inserted = Column(DateTime, default=datetime.utcnow)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
     inserted_by = Column(String(50), default='unknown')
-    last_updated = Column(DateTime, default=datetime.utcnow)
+    last_updated = Column(DateTime, server_default=utc_timestamp(),
+                          onupdate=utc_timestamp())
     last_updated_by = Column(String(50), default='unknown')
     last_updated_action = Column(String(6), default='INSERT')
 
@@ -678,3 +816,45 @@ class HealthstateType(Base):
                     self.last_updated,
                     self.last_updated_by,
                     self.last_updated_action))
+
+
+class ChangeJournal(Base):
+    """Append-only record of the row changes made by the RequestHandler.
+    Column values are stored as JSON; see epic_db.journal."""
+    __tablename__ = 'change_journal'
+
+    journal_id = Column(Integer, primary_key=True)
+    request_id = Column(String(255), default=None, index=True)
+    tablename = Column(String(64))
+    operation = Column(String(6))
+    primary_key = Column(Text)
+    before_values = Column(Text, default=None)
+    after_values = Column(Text, default=None)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
+
+    def __repr__(self):
+        return ("<ChangeJournal(journal_id: {}, request_id: {}, "
+                "tablename: {}, operation: {}, primary_key: {}, "
+                "before_values: {}, after_values: {}, "
+                "date_inserted: {})>".format(
+                    self.journal_id,
+                    self.request_id,
+                    self.tablename,
+                    self.operation,
+                    self.primary_key,
+                    self.before_values,
+                    self.after_values,
+                    self.date_inserted))
+
+
+class AppliedRequest(Base):
+    """Ledger of the ids of the requests the RequestHandler has applied."""
+    __tablename__ = 'applied_request'
+
+    request_id = Column(String(255), primary_key=True)
+    date_inserted = Column(DateTime, server_default=utc_timestamp())
+
+    def __repr__(self):
+        return ("<AppliedRequest(request_id: {}, date_inserted: {})>".format(
+            self.request_id,
+            self.date_inserted))
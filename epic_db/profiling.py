@@ -0,0 +1,94 @@
+"""
+Opt-in cProfile hooks around the expensive entry points.
+
+Functions decorated with profiled() run normally unless profiling is switched
+on, either for the whole process by setting the EPIC_DB_PROFILE_DIR
+environment variable to a directory, or for a block with profile_to::
+
+    with profile_to('/tmp/profiles'):
+        handler.process_request(request)
+
+Every call then writes its own profile to the directory, named
+``{name}.{timestamp}.{pid}.{call number}.prof``, which can be read with
+pstats or snakeviz. Profiled calls made inside another profiled call are
+part of the outer call's profile rather than getting their own.
+"""
+from contextlib import contextmanager
+import functools
+import itertools
+import os
+import threading
+import time
+
+PROFILE_DIR_ENV_VAR = 'EPIC_DB_PROFILE_DIR'
+
+_state = threading.local()
+_directory = None
+_call_numbers = itertools.count()
+
+
+def profile_directory():
+    """Return the directory profiles are written to, or None if profiling is
+    switched off. A profile_to block takes precedence over the environment
+    variable."""
+    if _directory is not None:
+        return _directory
+    return os.environ.get(PROFILE_DIR_ENV_VAR) or None
+
+
+@contextmanager
+def profile_to(directory):
+    """Profile every profiled() call made inside the block, writing the
+    profiles to directory. The directory is created if it doesn't exist."""
+    global _directory
+    previous = _directory
+    _directory = directory
+    try:
+        yield
+    finally:
+        _directory = previous
+
+
+def profiled(name):
+    """
+    Decorator profiling each call of a function while profiling is on.
+
+    Arguments:
+        name (str): the name the profile files start with, e.g.
+            'RequestHandler.process_request'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            directory = profile_directory()
+            if directory is None or getattr(_state, 'active', False):
+                return func(*args, **kwargs)
+            return _run_profiled(name, directory, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def _run_profiled(name, directory, func, args, kwargs):
+    import cProfile
+
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # newer pythons allow a single active profiler per process
+        return func(*args, **kwargs)
+    _state.active = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        _state.active = False
+        filename = '{}.{}.{}.{}.prof'.format(
+            name, time.strftime('%Y%m%dT%H%M%S'), os.getpid(),
+            next(_call_numbers))
+        profile.dump_stats(os.path.join(directory, filename))
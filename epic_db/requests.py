@@ -1,13 +1,19 @@
 import json
-import numpy as np
 
 from epic_db.constructors import RowConstructor
 from epic_db.errors import RowNotFoundError
+from epic_db.journal import journaled
+from epic_db.models import AppliedRequest, get_by_primary_key
+from epic_db.profiling import profiled
+from epic_db.validation import validate_request
+
+# optional outermost request key holding the request's id
+REQUEST_ID_KEY = 'request_id'
 
 
 class RequestHandler(object):
 
-    def __init__(self, session):
+    def __init__(self, session, journal=False, validate=True):
         """
         The RequestHandler is a class used to alter to the state of a database
         table.
@@ -18,8 +24,16 @@ class RequestHandler(object):
 
         Arguments:
             session (sqlalchemy.orm.Session)
+
+            journal (bool): record every row change in the change_journal
+                table. Default False.
+
+            validate (bool): check the structure of each request before
+                touching the database. Default True.
         """
         self.session = session
+        self.journal = journal
+        self.validate = validate
 
     def _unpack_request(self, request):
         """
@@ -42,7 +56,14 @@ class RequestHandler(object):
         else:
             return json.loads(request)
 
-    def process_request(self, request):
+    def is_applied(self, request_id):
+        """Return True if a request with this id is in the applied_request
+        ledger."""
+        return get_by_primary_key(
+            self.session, AppliedRequest, request_id) is not None
+
+    @profiled('RequestHandler.process_request')
+    def process_request(self, request, request_id=None):
         """
         Process the complete request.
 
@@ -53,15 +74,63 @@ class RequestHandler(object):
         The request will continue to be processed as long as a tablename exists
         in the 'tables' instance variable.
 
+        Requests with an id, given as request_id or as a 'request_id' key in
+        the request, are applied at most once: the id is recorded in the
+        applied_request ledger in the same transaction, and requests whose id
+        is already in the ledger are skipped.
+
         Arguments:
             request (dict): A dictionary representing each of the database
                 transactions to be completed in this request. The request
                 dictionary's outermost keys represent the individual tables
                 that will be processed over.
+
+            request_id (str): identifies the request in the applied_request
+                ledger and the change journal. Default None.
+
+        Raises:
+            ValueError: thrown if request_id and the request's 'request_id'
+                key differ.
+
+            RequestValidationError: thrown if the request is malformed,
+                listing every problem found. The only query run before
+                validation is the ledger lookup of a request with an id.
+
+        Returns:
+            False if the request was skipped as already applied, else True.
         """
         request = self._unpack_request(request)
+        if REQUEST_ID_KEY in request:
+            request = dict(request)
+            body_id = request.pop(REQUEST_ID_KEY)
+            if request_id is not None and request_id != body_id:
+                raise ValueError(
+                    "request_id {!r} doesn't match the request's id "
+                    "{!r}".format(request_id, body_id))
+            request_id = body_id
+        # a redelivered request is skipped without paying for validation
+        if request_id is not None and self.is_applied(request_id):
+            return False
+        if self.validate:
+            validate_request(request)
         self.tables = list(request.keys())
 
+        if not self.journal:
+            self._apply(request, request_id)
+        else:
+            with journaled(self.session, request_id):
+                self._apply(request, request_id)
+        return True
+
+    def _apply(self, request, request_id):
+        if request_id is not None:
+            # flushed first, so a concurrent duplicate fails on the ledger's
+            # primary key before doing any work
+            self.session.add(AppliedRequest(request_id=request_id))
+            self.session.flush()
+        self._process_tables(request)
+
+    def _process_tables(self, request):
         while self.tables:
             self._process_table(self.tables[0], request.get(self.tables[0]))
 
@@ -91,8 +160,9 @@ class RequestHandler(object):
         if row_dict is None:
             row_dict = {}
 
-        table_iter = np.atleast_1d(table_dict)
-        for entry in table_iter:
+        if not isinstance(table_dict, (list, tuple)):
+            table_dict = [table_dict]
+        for entry in table_dict:
             row, constructor = self._process_row(tablename, entry, row_dict)
             row_dict.update({tablename: row})
             # create a list of keys that aren't db tables or have been run
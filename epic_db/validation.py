@@ -0,0 +1,246 @@
+"""
+Request validation.
+
+Checks the structure of a request before the RequestHandler touches the
+database: known tablenames, known columns, value types and string lengths,
+required insert columns and the dependencies each insert needs. Every problem
+in the request is reported at once, so a mistake in the last row of a large
+request no longer surfaces after every earlier row has been flushed.
+
+The checks for each table are compiled once from the RowConstructor
+subclasses and the models, and shared by every request.
+
+Without the database, only rows missing a primary key are known to be
+inserts. Rows of tables whose whole composite key is given by the client,
+like sequela_hierarchy_history, are modified if the row exists and inserted
+otherwise, so their required insert columns are only checked once the
+RequestHandler finds the row missing.
+"""
+from datetime import datetime
+import math
+import numbers
+import threading
+
+from sqlalchemy import DateTime, Float, Integer, String
+
+from epic_db.constructors import RowConstructor, return_model_from_tablename
+from epic_db.errors import RequestValidationError
+
+# keys the RequestHandler accepts on any row besides the table's columns
+ROW_FLAGS = ['is_delete']
+
+_lock = threading.Lock()
+_schema = None
+
+
+def _is_integer(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, numbers.Integral):
+        return True
+    # ids read through pandas arrive as whole floats
+    return isinstance(value, float) and value.is_integer()
+
+
+def _is_missing(value):
+    # pandas delivers missing values of nullable columns as NaN
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _check_integer(value):
+    if not _is_integer(value):
+        return 'expected an integer, got {!r}'.format(value)
+
+
+def _check_float(value):
+    if isinstance(value, bool) or not isinstance(value, numbers.Real):
+        return 'expected a number, got {!r}'.format(value)
+
+
+def _check_datetime(value):
+    if not isinstance(value, (datetime, str)):
+        return 'expected a datetime, got {!r}'.format(value)
+
+
+def _check_flag(value):
+    if not isinstance(value, (bool, int)):
+        return 'expected a boolean, got {!r}'.format(value)
+
+
+def _check_children(value):
+    if not isinstance(value, (list, tuple)):
+        return 'expected a list of sequela ids, got {!r}'.format(value)
+    bad = [child for child in value if not _is_integer(child)]
+    if bad:
+        return 'expected integer sequela ids, got {!r}'.format(bad)
+
+
+def _string_checker(length):
+    def check(value):
+        if not isinstance(value, str):
+            return 'expected a string, got {!r}'.format(value)
+        if length is not None and len(value) > length:
+            return 'longer than {} characters'.format(length)
+    return check
+
+
+def _column_checker(column):
+    if isinstance(column.type, Integer):
+        return _check_integer
+    if isinstance(column.type, Float):
+        return _check_float
+    if isinstance(column.type, String):
+        return _string_checker(column.type.length)
+    if isinstance(column.type, DateTime):
+        return _check_datetime
+    return None
+
+
+class TableSchema(object):
+
+    def __init__(self, constructor):
+        """
+        The checks for the rows of one table, compiled from its
+        RowConstructor subclass and model.
+
+        Arguments:
+            constructor (RowConstructor subclass)
+        """
+        model = return_model_from_tablename(constructor.tablename)
+        self.tablename = constructor.tablename
+        self.primary_keys = [col.name for col in model.__mapper__.primary_key]
+        self.required = list(constructor.req_insert_cols or [])
+        self.checkers = {}
+        for column in model.__table__.columns:
+            self.checkers[column.name] = _column_checker(column)
+        for col in constructor.insert_cols:
+            self.checkers.setdefault(col, None)
+        if 'children' in self.checkers:
+            self.checkers['children'] = _check_children
+        for flag in ROW_FLAGS:
+            self.checkers[flag] = _check_flag
+        # each dependency is satisfied by a row processed earlier in the
+        # request or by the dependency's primary keys in the row itself
+        self.dependencies = {}
+        for dep in (constructor.dependency_map or {}):
+            dep_model = return_model_from_tablename(dep)
+            self.dependencies[dep] = [
+                col.name for col in dep_model.__mapper__.primary_key]
+
+
+class RequestSchema(object):
+
+    def __init__(self, constructors):
+        """
+        Validates whole requests against the TableSchemas of a list of
+        RowConstructor subclasses.
+        """
+        self.tables = {constructor.tablename: TableSchema(constructor)
+                       for constructor in constructors}
+
+    def validate(self, request):
+        """
+        Return every problem found in a request.
+
+        Arguments:
+            request (dict): an unpacked request, without its request_id.
+
+        Returns:
+            A list of (path, message) tuples, empty if the request is valid.
+                The path locates the problem, e.g.
+                'sequela[3].sequela_hierarchy_history.cause_id'.
+        """
+        errors = []
+        if not isinstance(request, dict):
+            errors.append(('', 'expected a dictionary of tables, got '
+                               '{!r}'.format(type(request).__name__)))
+            return errors
+        for tablename, table_dict in request.items():
+            if tablename not in self.tables:
+                errors.append((tablename, 'unknown table'))
+                continue
+            # the RequestHandler starts a new row_dict for every top level
+            # table, so rows of one can't satisfy the dependencies of another
+            seen = set()
+            self._validate_table(tablename, table_dict, tablename, seen,
+                                 errors)
+        return errors
+
+    def check(self, request):
+        """
+        Raise if a request is invalid.
+
+        Raises:
+            RequestValidationError: listing every problem in the request.
+        """
+        errors = self.validate(request)
+        if errors:
+            raise RequestValidationError(
+                "Invalid request:\n{}".format('\n'.join(
+                    '{}: {}'.format(path, message)
+                    for path, message in errors)), errors=errors)
+
+    def _validate_table(self, tablename, table_dict, path, seen, errors):
+        if isinstance(table_dict, (list, tuple)):
+            for i, entry in enumerate(table_dict):
+                self._validate_row(tablename, entry,
+                                   '{}[{}]'.format(path, i), seen, errors)
+        else:
+            self._validate_row(tablename, table_dict, path, seen, errors)
+
+    def _validate_row(self, tablename, row, path, seen, errors):
+        if not isinstance(row, dict):
+            errors.append((path, 'expected a dictionary of columns, got '
+                                 '{!r}'.format(type(row).__name__)))
+            return
+        schema = self.tables[tablename]
+
+        # rows missing a primary key are always inserted. A row with its
+        # whole key may be an insert too, but telling needs the database
+        if any(row.get(key) is None for key in schema.primary_keys):
+            missing = [col for col in schema.required if col not in row]
+            if missing:
+                errors.append((path, 'missing columns {} required for '
+                                     'insert'.format(missing)))
+            for dep, keys in sorted(schema.dependencies.items()):
+                if dep not in seen and any(row.get(key) is None
+                                           for key in keys):
+                    errors.append((path, 'insert needs a {} row: nest it '
+                                         'in one or give {}'.format(
+                                             dep, keys)))
+        seen.add(tablename)
+
+        for key, value in row.items():
+            key_path = '{}.{}'.format(path, key)
+            if key in schema.checkers:
+                check = schema.checkers[key]
+                message = None
+                if not _is_missing(value) and check is not None:
+                    message = check(value)
+                if message:
+                    errors.append((key_path, message))
+            elif key in self.tables:
+                self._validate_table(key, value, key_path, seen, errors)
+            else:
+                errors.append((key_path, 'unknown column or table'))
+
+
+def get_request_schema():
+    """Return the RequestSchema for the RowConstructor subclasses, compiling
+    it on first use."""
+    global _schema
+    if _schema is None:
+        with _lock:
+            if _schema is None:
+                _schema = RequestSchema(RowConstructor.__subclasses__())
+    return _schema
+
+
+def validate_request(request):
+    """
+    Validate a request without touching the database.
+
+    Raises:
+        RequestValidationError: listing every problem in the request.
+    """
+    get_request_schema().check(request)
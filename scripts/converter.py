@@ -1,6 +1,8 @@
+import itertools
 import os
 import pandas as pd
 
+from epic_db.profiling import profiled
 from epic_db.models import (Sequela,
                             SequelaSet,
                             SequelaSetVersion)
@@ -11,7 +13,12 @@ class XlsProcessor(object):
     _valid_columns = ['cause_id', 'sequela_id', 'sequela_name', 'lvl_5_name']
 
     def _fill_merged_cells(self):
-        self.data.fillna(method='ffill', inplace=True)
+        self.data.ffill(inplace=True)
+        # leading blanks continue the merged cells of the previous chunk
+        if self._last_row is not None:
+            self.data.fillna(self._last_row, inplace=True)
+        if len(self.data):
+            self._last_row = self.data.iloc[-1]
 
     def _rename_columns(self):
         self.data.rename(columns={'Name level 5 hierarchy': 'lvl_5_name'},
@@ -27,22 +34,127 @@ class XlsProcessor(object):
     def _drop_row_nans(self):
         self.data.dropna(axis=0, subset=['sequela_id'], inplace=True)
 
-    def run(self, path):
-        self.data = pd.read_excel(path)
-        self._drop_row_nans()
-        self._drop_unidentified_column()
-        self._rename_columns()
-        self._fill_merged_cells()
-        return self.data[self._valid_columns]
+    def _read_chunks(self, path, chunksize=None):
+        """Yield raw frames of at most chunksize rows from a csv, parquet or
+        excel file. Without a chunksize the whole file is one frame."""
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.csv':
+            if chunksize is None:
+                yield pd.read_csv(path)
+            else:
+                for chunk in pd.read_csv(path, chunksize=chunksize):
+                    yield chunk
+        elif extension == '.parquet':
+            if chunksize is None:
+                yield pd.read_parquet(path)
+            else:
+                import pyarrow.parquet as pq
+                start = 0
+                for batch in pq.ParquetFile(path).iter_batches(
+                        batch_size=chunksize):
+                    chunk = batch.to_pandas()
+                    chunk.index += start
+                    start += len(chunk)
+                    yield chunk
+        elif chunksize is None or extension == '.xls':
+            yield pd.read_excel(path)
+        else:
+            for chunk in self._read_excel_chunks(path, chunksize):
+                yield chunk
+
+    def _read_excel_chunks(self, path, chunksize):
+        """Stream the first sheet of an xlsx workbook in read-only mode,
+        naming blank headers the way pandas.read_excel does."""
+        import openpyxl
+        workbook = openpyxl.load_workbook(path, read_only=True,
+                                          data_only=True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = ['Unnamed: {}'.format(i) if name is None else name
+                       for i, name in enumerate(header)]
+            start = 0
+            while True:
+                values = list(itertools.islice(rows, chunksize))
+                if not values:
+                    break
+                yield pd.DataFrame(
+                    values, columns=columns,
+                    index=pd.RangeIndex(start, start + len(values)))
+                start += len(values)
+        finally:
+            workbook.close()
+
+    def iter_chunks(self, path, chunksize=10000):
+        """
+        Yield the cleaned mapping data of a file in chunks.
+
+        Chunks are cleaned the same way as run() cleans the whole file, with
+        merged cells carried over from one chunk to the next, so
+        concatenating the chunks gives the same frame as run().
+
+        Arguments:
+            path (str): an .xlsx, .xls, .csv or .parquet mapping file. .xls
+                files can't be streamed and are read whole.
+
+            chunksize (int): the maximum number of rows read at a time.
+                Default 10000. None reads the whole file at once.
+        """
+        self._last_row = None
+        for chunk in self._read_chunks(path, chunksize):
+            self.data = chunk
+            self._drop_row_nans()
+            self._drop_unidentified_column()
+            self._rename_columns()
+            self._fill_merged_cells()
+            yield self.data[self._valid_columns]
+
+    @profiled('XlsProcessor.run')
+    def run(self, path, chunksize=None):
+        """
+        Return the cleaned mapping data of a file.
+
+        Arguments:
+            path (str): an .xlsx, .xls, .csv or .parquet mapping file.
+
+            chunksize (int): if given, the file is read and cleaned this many
+                rows at a time. Default None reads the whole file at once.
+                The returned frame still holds the whole file; load large
+                files with DataFrameLoader.load_file to bound memory.
+        """
+        chunks = list(self.iter_chunks(path, chunksize=chunksize))
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            return pd.DataFrame(columns=self._valid_columns)
+        return pd.concat(chunks)
 
 
 class JsonConverter(object):
 
-    def __init__(self, dataframe, session=None):
+    # maximum number of names sent in a single IN clause
+    name_chunk_size = 1000
+
+    def __init__(self, dataframe, session=None, name_to_id=None):
+        """
+        Arguments:
+            dataframe (pandas.DataFrame): a frame as returned by
+                XlsProcessor.run or one of its chunks.
+
+            session (sqlalchemy.orm.Session): used to resolve level 5 names.
+                Default None.
+
+            name_to_id (dict): the cache of resolved names, updated in place,
+                so converters of successive chunks can share one. Default
+                None starts an empty cache.
+        """
         self.dataframe = dataframe
         self.session = session
         self.most_detailed = dataframe.sequela_id.tolist()
         self.level_5 = dataframe.lvl_5_name.unique().tolist()
+        self._name_to_id = {} if name_to_id is None else name_to_id
 
     def _create_most_detailed(self, sequela_id, sequela_name, version_id,
                               cause_id):
@@ -57,10 +169,42 @@ class JsonConverter(object):
         return {'sequela_id': None,
                 'sequela_name': sequela_name}
 
+    def resolve_names(self, sequela_names):
+        """
+        Map sequela names to sequela ids.
+
+        Names not resolved before are looked up with one IN query per
+        name_chunk_size names, and the results are cached for the lifetime
+        of the converter.
+
+        Arguments:
+            sequela_names (str list): the names to resolve.
+
+        Raises:
+            ValueError: thrown if any name has no row in the sequela table.
+                All unknown names are reported together.
+
+        Returns:
+            A dict mapping every name to its sequela_id.
+        """
+        to_resolve = sorted(set(name for name in sequela_names
+                                if name not in self._name_to_id))
+        for start in range(0, len(to_resolve), self.name_chunk_size):
+            chunk = to_resolve[start:start + self.name_chunk_size]
+            self._name_to_id.update(self.session.query(
+                Sequela.sequela_name, Sequela.sequela_id).filter(
+                Sequela.sequela_name.in_(chunk)))
+
+        unknown = [name for name in to_resolve
+                   if name not in self._name_to_id]
+        if unknown:
+            raise ValueError(
+                "Sequela names {} not found in epic.sequela table.".format(
+                    unknown))
+        return {name: self._name_to_id[name] for name in sequela_names}
+
     def _get_id_from_name(self, lvl_5_name):
-        seq_id = self.session.query(Sequela).filter(
-            Sequela.sequela_name == lvl_5_name).first().sequela_id
-        return seq_id
+        return self.resolve_names([lvl_5_name])[lvl_5_name]
 
     def _create_hierarchy_row(self, lvl_5_id, version_id, cause_id, children):
         return {'sequela_id': lvl_5_id,
@@ -68,32 +212,32 @@ class JsonConverter(object):
                 'cause_id': cause_id,
                 'children': children}
 
+    @profiled('JsonConverter.create_all_most_detailed')
     def create_all_most_detailed(self, version_id=None):
-        output = {'sequela': []}
-        for _, row in self.dataframe.iterrows():
-            row_dict = row.to_dict()
-            sequela_id = row_dict['sequela_id']
-            sequela_name = row_dict['sequela_name']
-            cause_id = row_dict['cause_id']
-            output['sequela'].append(
-                self._create_most_detailed(sequela_id, sequela_name,
-                                           version_id, cause_id))
-        return output
-
+        columns = [self.dataframe[col].tolist() for col in
+                   ['sequela_id', 'sequela_name', 'cause_id']]
+        return {'sequela': [
+            self._create_most_detailed(sequela_id, sequela_name, version_id,
+                                       cause_id)
+            for sequela_id, sequela_name, cause_id in zip(*columns)]}
+
+    @profiled('JsonConverter.create_all_aggregates')
     def create_all_aggregates(self):
-        output = {'sequela': []}
-        for lvl_5 in self.level_5:
-            children = self.dataframe[self.dataframe.lvl_5_name == lvl_5]
-            output['sequela'].append(self._create_aggregate(lvl_5))
-        return output
+        return {'sequela': [self._create_aggregate(lvl_5)
+                            for lvl_5 in self.level_5]}
 
+    @profiled('JsonConverter.create_hierarchy')
     def create_hierarchy(self, version_id=None):
         output = {'sequela_hierarchy_history': []}
+        # groups come out in order of first appearance, like level_5
+        grouped = self.dataframe.groupby('lvl_5_name', sort=False)
+        all_children = grouped.sequela_id.apply(list)
+        all_cause_ids = grouped.cause_id.unique()
+        lvl_5_ids = self.resolve_names(self.level_5)
         for lvl_5 in self.level_5:
-            lvl_5_id = self._get_id_from_name(lvl_5)
-            this_data = self.dataframe[self.dataframe.lvl_5_name == lvl_5]
-            children = [int(child) for child in this_data.sequela_id.tolist()]
-            cause_ids = [int(cause) for cause in this_data.cause_id.unique()]
+            lvl_5_id = lvl_5_ids[lvl_5]
+            children = [int(child) for child in all_children[lvl_5]]
+            cause_ids = [int(cause) for cause in all_cause_ids[lvl_5]]
             assert len(cause_ids) == 1, print(cause_ids)
             output['sequela_hierarchy_history'].append(
                 self._create_hierarchy_row(lvl_5_id, version_id, cause_ids[0],
@@ -0,0 +1,287 @@
+import sqlalchemy as sql
+
+from epic_db.models import (get_by_primary_key,
+                            Sequela,
+                            SequelaSetVersion,
+                            SequelaHierarchyHistory)
+from scripts.converter import JsonConverter, XlsProcessor
+
+
+class DataFrameLoader(object):
+
+    # number of rows sent per executemany batch or IN clause
+    batch_size = 1000
+
+    def __init__(self, dataframe, session):
+        """
+        Bulk load a mapping frame straight into the database.
+
+        Writes the same rows as converting the frame with JsonConverter and
+        running the requests through a RequestHandler, but with one
+        executemany insert per table and batch instead of a flush per row.
+        Meant for the initial load of a hierarchy into a version that only
+        has a root.
+
+        Arguments:
+            dataframe (pandas.DataFrame): a frame as returned by
+                XlsProcessor.run, with cause_id, sequela_id, sequela_name and
+                lvl_5_name columns.
+
+            session (sqlalchemy.orm.Session): a session connecting to the
+                database to load into. Changes are not committed.
+        """
+        self.dataframe = dataframe
+        self.session = session
+        # resolved names and loaded level 5 rows are kept across chunks
+        self._name_to_id = {}
+        self._aggregates = {}
+        self.converter = JsonConverter(dataframe, session=session,
+                                       name_to_id=self._name_to_id)
+
+    @classmethod
+    def load_file(cls, path, session, version_id, chunksize=10000):
+        """
+        Load a mapping file chunk by chunk with XlsProcessor.iter_chunks, so
+        only one chunk is in memory at a time.
+
+        The file is read twice: first to insert and rename the most detailed
+        sequela, then to insert the level 5 aggregates and the hierarchy, so
+        the ids given to new aggregates can't collide with most detailed ids
+        further down the file. A level 5 aggregate can have children in
+        several chunks; it is inserted with the first of them. Resolved names
+        are cached across chunks.
+
+        Arguments:
+            path (str): a mapping file, see XlsProcessor.iter_chunks.
+
+            session (sqlalchemy.orm.Session): a session connecting to the
+                database to load into. Changes are not committed.
+
+            version_id (int): the sequela_set_version to load into.
+
+            chunksize (int): the maximum number of rows in memory at a time.
+                Default 10000.
+
+        Raises:
+            ValueError: thrown if a chunk can't be loaded, see load. A sequela
+                listed in more than one chunk is reported as already in the
+                hierarchy.
+
+        Returns:
+            A dict of inserted and renamed sequela counts and inserted
+                hierarchy row counts, summed over the chunks.
+        """
+        counts = {'inserted': 0, 'renamed': 0, 'hierarchy': 0}
+        loader = None
+        for with_aggregates in (False, True):
+            for chunk in XlsProcessor().iter_chunks(path, chunksize=chunksize):
+                if loader is None:
+                    loader = cls(chunk, session)
+                else:
+                    loader._use_frame(chunk)
+                if with_aggregates:
+                    chunk_counts = loader.load(version_id)
+                else:
+                    chunk_counts = loader.load_sequela(aggregates=False)
+                for key, count in chunk_counts.items():
+                    counts[key] += count
+        return counts
+
+    def _use_frame(self, dataframe):
+        self.dataframe = dataframe
+        self.converter = JsonConverter(dataframe, session=self.session,
+                                       name_to_id=self._name_to_id)
+
+    def _batches(self, rows):
+        for start in range(0, len(rows), self.batch_size):
+            yield rows[start:start + self.batch_size]
+
+    def _execute(self, stmt, rows):
+        for batch in self._batches(rows):
+            self.session.execute(stmt, batch)
+
+    def _existing_sequela(self, sequela_ids):
+        existing = {}
+        for batch in self._batches(sequela_ids):
+            existing.update(self.session.query(
+                Sequela.sequela_id, Sequela.sequela_name).filter(
+                Sequela.sequela_id.in_(batch)))
+        return existing
+
+    def _existing_names(self, sequela_names):
+        existing = set()
+        for batch in self._batches(sequela_names):
+            existing.update(name for name, in self.session.query(
+                Sequela.sequela_name).filter(
+                Sequela.sequela_name.in_(batch)))
+        return existing
+
+    def _aggregate_causes(self):
+        """Return the cause_id of each level 5 aggregate, which must be the
+        cause_id shared by all of its children, including children loaded
+        from earlier chunks."""
+        causes = self.dataframe.groupby('lvl_5_name', sort=False).cause_id
+        first = causes.first()
+        mixed = [lvl_5 for lvl_5, count in causes.nunique().items()
+                 if count != 1 or (
+                     lvl_5 in self._aggregates and
+                     self._aggregates[lvl_5]['cause_id'] != int(first[lvl_5]))]
+        if mixed:
+            raise ValueError(
+                "Children of level 5 aggregates {} don't share a single "
+                "cause_id".format(sorted(mixed)))
+        return first
+
+    def load_sequela(self, aggregates=True):
+        """
+        Insert missing most detailed and aggregate sequela, and rename
+        existing most detailed sequela whose names differ from the frame.
+
+        Arguments:
+            aggregates (bool): also insert missing level 5 aggregates.
+                Default True.
+
+        Returns:
+            A dict of inserted and renamed row counts.
+        """
+        most_detailed = {
+            int(sequela_id): sequela_name for sequela_id, sequela_name in
+            zip(self.dataframe.sequela_id.tolist(),
+                self.dataframe.sequela_name.tolist())}
+        existing = self._existing_sequela(list(most_detailed))
+
+        new_rows = [{'sequela_id': sequela_id, 'sequela_name': sequela_name}
+                    for sequela_id, sequela_name in most_detailed.items()
+                    if sequela_id not in existing]
+        renamed = [{'b_sequela_id': sequela_id, 'b_sequela_name': sequela_name}
+                   for sequela_id, sequela_name in most_detailed.items()
+                   if sequela_id in existing and
+                   existing[sequela_id] != sequela_name]
+
+        if aggregates:
+            existing_names = self._existing_names(self.converter.level_5)
+            new_rows.extend({'sequela_name': name}
+                            for name in self.converter.level_5
+                            if name not in existing_names)
+
+        # rows with and without an explicit id are inserted separately since
+        # an executemany batch must share one set of columns
+        table = Sequela.__table__
+        self._execute(table.insert(),
+                      [row for row in new_rows if 'sequela_id' in row])
+        self._execute(table.insert(),
+                      [row for row in new_rows if 'sequela_id' not in row])
+        self._execute(table.update().where(
+            table.c.sequela_id == sql.bindparam('b_sequela_id')).values(
+            sequela_name=sql.bindparam('b_sequela_name')), renamed)
+
+        return {'inserted': len(new_rows), 'renamed': len(renamed)}
+
+    def load_hierarchy(self, version_id):
+        """
+        Insert the level 5 aggregates as children of the root of a version's
+        hierarchy, and the most detailed sequela as their children.
+
+        Arguments:
+            version_id (int): the sequela_set_version to load into.
+
+        Raises:
+            ValueError: thrown if the version or its root row doesn't exist,
+                if any of the sequela are already in its hierarchy, or if the
+                children of a level 5 aggregate have different cause_ids.
+
+        Returns:
+            The number of sequela_hierarchy_history rows inserted.
+        """
+        aggregate_causes = self._aggregate_causes()
+        version = get_by_primary_key(self.session, SequelaSetVersion,
+                                     version_id)
+        if not version:
+            raise ValueError(
+                "Sequela_set_version_id {} not found in "
+                "epic.sequela_set_version table.".format(version_id))
+        root = get_by_primary_key(self.session, SequelaHierarchyHistory,
+                                  (version_id, 0))
+        if not root:
+            raise ValueError(
+                "Sequela_set_version {} has no root row to load the "
+                "hierarchy under".format(version_id))
+
+        lvl_5_ids = self.converter.resolve_names(self.converter.level_5)
+        aggregates = {}
+        for lvl_5, cause_id in aggregate_causes.items():
+            if lvl_5 not in self._aggregates:
+                aggregates[lvl_5] = self._hierarchy_row(
+                    version, lvl_5_ids[lvl_5], lvl_5, root, cause_id,
+                    most_detailed=0)
+        rows = list(aggregates.values())
+        parents = dict(self._aggregates)
+        parents.update(aggregates)
+        # a sequela listed more than once gets one row, from its last entry
+        # like its name in load_sequela
+        most_detailed = self.dataframe.drop_duplicates(
+            'sequela_id', keep='last')
+        for sequela_id, sequela_name, cause_id, lvl_5 in zip(
+                *[most_detailed[col].tolist() for col in
+                  ['sequela_id', 'sequela_name', 'cause_id', 'lvl_5_name']]):
+            rows.append(self._hierarchy_row(
+                version, int(sequela_id), sequela_name,
+                parents[lvl_5], cause_id, most_detailed=1))
+
+        already_loaded = []
+        for batch in self._batches([row['sequela_id'] for row in rows]):
+            already_loaded.extend(sequela_id for sequela_id, in
+                                  self.session.query(
+                                      SequelaHierarchyHistory.sequela_id).
+                                  filter(
+                                      SequelaHierarchyHistory.
+                                      sequela_set_version_id == version_id,
+                                      SequelaHierarchyHistory.sequela_id.in_(
+                                          batch)))
+        if already_loaded:
+            raise ValueError(
+                "Sequela_ids {} are already in the hierarchy of "
+                "sequela_set_version {}".format(
+                    sorted(already_loaded), version_id))
+
+        # aggregates come first so every parent exists before its children
+        self._execute(SequelaHierarchyHistory.__table__.insert(), rows)
+        self._aggregates.update(aggregates)
+        return len(rows)
+
+    def _hierarchy_row(self, version, sequela_id, sequela_name, parent,
+                       cause_id, most_detailed):
+        if isinstance(parent, SequelaHierarchyHistory):
+            parent = {'sequela_id': parent.sequela_id, 'level': parent.level,
+                      'path_to_top_parent': parent.path_to_top_parent}
+        return {'sequela_set_version_id': version.sequela_set_version_id,
+                'sequela_set_id': version.sequela_set_id,
+                'sequela_id': sequela_id,
+                'level': parent['level'] + 1,
+                'most_detailed': most_detailed,
+                'parent_id': parent['sequela_id'],
+                'path_to_top_parent': '{},{}'.format(
+                    parent['path_to_top_parent'], sequela_id),
+                'sequela_name': sequela_name,
+                'cause_id': int(cause_id)}
+
+    def load(self, version_id):
+        """
+        Load the sequela and the hierarchy of the frame into a version.
+
+        Arguments:
+            version_id (int): the sequela_set_version to load into.
+
+        Raises:
+            ValueError: thrown if the hierarchy can't be loaded, see
+                load_hierarchy. Nothing is inserted if the children of a level
+                5 aggregate have different cause_ids.
+
+        Returns:
+            A dict of inserted and renamed sequela counts and inserted
+                hierarchy row counts.
+        """
+        self._aggregate_causes()
+        counts = self.load_sequela()
+        counts['hierarchy'] = self.load_hierarchy(version_id)
+        return counts
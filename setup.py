@@ -41,4 +41,5 @@ setup(
     author_email='mlsandar@uw.edu, atheis@uw.edu, benmiltz@uw.edu',
     install_requires=[],
     packages=['epic_db'],
-    entry_points={'console_scripts': []})
+    entry_points={'console_scripts': [
+        'epic_db_apply = epic_db.cli:main']})
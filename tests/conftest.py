@@ -1,6 +1,9 @@
+from contextlib import contextmanager
+
 import pytest
 
 from epic_db.database import create_db, delete_db, config
+from epic_db.metrics import QueryCounter
 from epic_db import models
 
 one_set_two_versions = {1: {
@@ -204,3 +207,17 @@ def two_sets_four_versions_sqlite():
     test_db.add_data(two_sets_four_versions)
     yield test_db
     delete_db()
+
+
+@pytest.fixture
+def query_budget():
+    """Return a context manager that fails the test if the block executes
+    more than budget statements on the default engine."""
+    @contextmanager
+    def budget(max_queries):
+        with QueryCounter(config.engine) as counter:
+            yield counter
+        assert counter.count <= max_queries, (
+            '{} statements executed, budget is {}:\n{}'.format(
+                counter.count, max_queries, '\n'.join(counter.statements)))
+    return budget
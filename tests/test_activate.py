@@ -1,8 +1,20 @@
 import pytest
-from epic_db.activate import activate_sequela_set_version
-from epic_db.models import (Sequela,
+import sqlalchemy as sql
+from sqlalchemy.orm import Session
+
+from epic_db.activate import (ActivateSequelaVersion,
+                              activate_sequela_set_version,
+                              activate_sequela_set_versions,
+                              check_hierarchy_integrity,
+                              register_validator,
+                              unregister_validator)
+from epic_db.database import config
+from epic_db.models import (Base,
+                            Sequela,
+                            SequelaSet,
                             SequelaSetVersion,
-                            SequelaSetVersionActive)
+                            SequelaSetVersionActive,
+                            SequelaHierarchyHistory)
 from epic_db.errors import SequelaSetVersionValidationError
 
 
@@ -110,3 +122,238 @@ def test_validation_fail(two_sets_four_versions_sqlite):
         session.commit()
 
         activate_sequela_set_version(4, gbd_round_id=5)
+
+
+def test_hierarchy_validation_fail(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    # flag an aggregate as most detailed and give its children mixed causes
+    seq_6 = session.query(SequelaHierarchyHistory).get([4, 6])
+    seq_6.most_detailed = 1
+    session.query(SequelaHierarchyHistory).get([4, 61]).cause_id = 294
+    session.query(SequelaHierarchyHistory).get([4, 62]).cause_id = 295
+    seq_6.cause_id = 294
+    session.commit()
+
+    with pytest.raises(SequelaSetVersionValidationError) as exc:
+        activate_sequela_set_version(4, gbd_round_id=5)
+
+    assert 'most_detailed' in str(exc.value)
+    assert 'cause_id' in str(exc.value)
+
+
+def test_check_hierarchy_integrity():
+    valid = [(0, 0, 0, 0, '0', None),
+             (1, 0, 1, 0, '0,1', 294),
+             (11, 1, 2, 1, '0,1,11', 294),
+             (12, 1, 2, 1, None, 294),
+             (2, 0, 1, 1, '0,2', 295)]
+    assert not check_hierarchy_integrity(valid)
+
+    invalid = valid + [(3, 4, 2, 1, None, None),
+                       (4, 3, 2, 1, None, None),
+                       (5, 99, 1, 1, None, None),
+                       (13, 1, 3, 1, '0,1,13', 294)]
+    problems = check_hierarchy_integrity(invalid)
+    assert problems['cycle'] == [3, 4]
+    assert problems['dangling parent_id'] == [5]
+    assert 13 in problems['level']
+    assert problems['path_to_top_parent'] == [13]
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_validation_reports_all_failures(two_sets_four_versions_sqlite,
+                                         max_workers):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    # break both the rei mapping and the hierarchy of version 4
+    version_4 = session.query(SequelaSetVersion).get(4)
+    version_4.add_sequela_rei(session.query(Sequela).get(21), rei_id=88)
+    session.query(SequelaHierarchyHistory).get([4, 7]).most_detailed = 0
+    session.commit()
+
+    with pytest.raises(SequelaSetVersionValidationError) as exc:
+        activate_sequela_set_version(4, gbd_round_id=5,
+                                     max_workers=max_workers)
+
+    assert set(exc.value.failures) == {'has_shh_for_rei',
+                                       'has_valid_hierarchy'}
+    assert session.query(SequelaSetVersionActive).get((2, 5)) is None
+
+
+def test_activate_many_versions(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    session.add(SequelaSetVersionActive(
+        sequela_set_id=1, gbd_round_id=5, sequela_set_version_id=1))
+    session.commit()
+
+    activate_sequela_set_versions([(2, 5), (4, 5), (3, 4)])
+
+    session.close()
+    session = db.session
+    assert session.query(SequelaSetVersionActive).get(
+        (1, 5)).sequela_set_version_id == 2
+    assert session.query(SequelaSetVersionActive).get(
+        (2, 5)).sequela_set_version_id == 4
+    assert session.query(SequelaSetVersionActive).get(
+        (2, 4)).sequela_set_version_id == 3
+    assert len(session.query(SequelaSetVersionActive).all()) == 3
+
+
+def test_activate_many_versions_fail(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    version_4 = session.query(SequelaSetVersion).get(4)
+    version_4.add_sequela_rei(session.query(Sequela).get(21), rei_id=88)
+    session.commit()
+
+    with pytest.raises(ValueError):
+        activate_sequela_set_versions([(3, 5), (4, 5)])
+
+    with pytest.raises(SequelaSetVersionValidationError) as exc:
+        activate_sequela_set_versions([(2, 5), (4, 5)])
+    assert list(exc.value.failures) == [4]
+
+    # no version is activated if any version fails validation
+    assert not session.query(SequelaSetVersionActive).all()
+
+
+def test_sync_sequela_names(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    session.query(Sequela).get(61).sequela_name = 'renamed sequela 61'
+    session.query(SequelaHierarchyHistory).get([4, 62]).sequela_name = None
+    session.flush()
+
+    changed = ActivateSequelaVersion(session, 4, 5).sync_sequela_names()
+
+    assert changed == [
+        {'sequela_id': 61, 'old_name': 'test sequela 61',
+         'new_name': 'renamed sequela 61'},
+        {'sequela_id': 62, 'old_name': None,
+         'new_name': 'test sequela 62'}]
+    assert session.query(SequelaHierarchyHistory).get(
+        [4, 61]).sequela_name == 'renamed sequela 61'
+    assert session.query(SequelaHierarchyHistory).get(
+        [4, 62]).sequela_name == 'test sequela 62'
+
+    # other versions are left untouched
+    assert session.query(SequelaHierarchyHistory).get(
+        [3, 61]).sequela_name == 'test sequela 61'
+
+
+def _broken_version_engine(path):
+    """A file-backed database holding version 1, whose only child sequela
+    is wrongly flagged as an aggregate."""
+    engine = sql.create_engine('sqlite:///{}'.format(path))
+    Base.metadata.create_all(engine)
+    engine.execute(SequelaSet.__table__.insert(),
+                   [{'sequela_set_id': 1, 'sequela_set_name': 'other'}])
+    engine.execute(SequelaSetVersion.__table__.insert(),
+                   [{'sequela_set_version_id': 1, 'sequela_set_id': 1,
+                     'gbd_round_id': 5}])
+    engine.execute(Sequela.__table__.insert(),
+                   [{'sequela_id': 0, 'sequela_name': 'root'},
+                    {'sequela_id': 1, 'sequela_name': 'child'}])
+    engine.execute(SequelaHierarchyHistory.__table__.insert(), [
+        {'sequela_set_version_id': 1, 'sequela_set_id': 1, 'sequela_id': 0,
+         'parent_id': 0, 'level': 0, 'most_detailed': 0,
+         'path_to_top_parent': '0'},
+        {'sequela_set_version_id': 1, 'sequela_set_id': 1, 'sequela_id': 1,
+         'parent_id': 0, 'level': 1, 'most_detailed': 0,
+         'path_to_top_parent': '0,1'}])
+    return engine
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_validation_uses_session_bind(empty_schema_sqlite, tmpdir,
+                                      max_workers):
+    # the default engine has no version 1; validators must check the
+    # database the activating session is bound to
+    engine = _broken_version_engine(str(tmpdir.join('other.db')))
+    session = Session(bind=engine)
+    try:
+        activate = ActivateSequelaVersion(session, 1, 5)
+        with pytest.raises(SequelaSetVersionValidationError) as exc:
+            activate.validate_version(max_workers=max_workers)
+        assert list(exc.value.failures) == ['has_valid_hierarchy']
+    finally:
+        session.close()
+        engine.dispose()
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_validation_ignores_replica(two_sets_four_versions_sqlite, tmpdir,
+                                    max_workers):
+    two_sets_four_versions_sqlite.session.commit()
+    # a replica that hasn't caught up with the primary yet
+    url = 'sqlite:///{}'.format(tmpdir.join('replica.db'))
+    config.register_engine('stale', conn_str=url, replica_of='default')
+    Base.metadata.create_all(config.get_engine('stale'))
+    try:
+        activate_sequela_set_version(4, gbd_round_id=5,
+                                     max_workers=max_workers)
+    finally:
+        config.remove_engine('stale')
+
+    session = two_sets_four_versions_sqlite.session
+    assert session.query(SequelaSetVersionActive).get(
+        (2, 5)).sequela_set_version_id == 4
+
+
+def test_validation_sees_synced_names(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+    session.query(Sequela).get(61).sequela_name = 'renamed sequela 61'
+    session.commit()
+
+    def names_in_sync(activate):
+        name = activate.session.query(SequelaHierarchyHistory).get(
+            [4, 61]).sequela_name
+        if name != 'renamed sequela 61':
+            raise SequelaSetVersionValidationError(name)
+
+    activate_sequela_set_version(
+        4, gbd_round_id=5, max_workers=2, sync_names=True,
+        validators=ActivateSequelaVersion.validators + [names_in_sync])
+
+
+def test_parallel_validation_keeps_pending_changes(
+        two_sets_four_versions_sqlite):
+    # the in-memory test database has one shared connection, so validation
+    # must not roll back the caller's transaction from a worker session
+    session = two_sets_four_versions_sqlite.session
+    session.query(Sequela).get(2).sequela_name = 'renamed sequela 2'
+    session.flush()
+
+    ActivateSequelaVersion(session, 4, 5).validate_version(max_workers=2)
+
+    assert session.query(Sequela.sequela_name).filter(
+        Sequela.sequela_id == 2).scalar() == 'renamed sequela 2'
+
+
+def test_register_validator(two_sets_four_versions_sqlite):
+    session = two_sets_four_versions_sqlite.session
+
+    def always_fails(activate):
+        raise SequelaSetVersionValidationError('always fails')
+
+    activate = ActivateSequelaVersion(session, 4, 5)
+    register_validator(always_fails)
+    try:
+        # instances copy the registered validators when created
+        activate.validate_version()
+        with pytest.raises(SequelaSetVersionValidationError):
+            ActivateSequelaVersion(session, 4, 5).validate_version()
+    finally:
+        unregister_validator(always_fails)
+
+    ActivateSequelaVersion(session, 4, 5).validate_version()
+    with pytest.raises(ValueError):
+        unregister_validator(always_fails)
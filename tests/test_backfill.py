@@ -19,6 +19,8 @@ def test_backfill(two_sets_four_versions_sqlite):
 
     version_4.add_sequela_rei(sequela_11, 82)
     version_4.add_sequela_rei(sequela_33, 85)
+    # rows written in one transaction share a timestamp
+    session.commit()
 
     # create a new version and backfill with version 4
     set_2.add_version(sequela_set_version="new version",
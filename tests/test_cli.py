@@ -0,0 +1,120 @@
+import json
+
+import pytest
+
+from epic_db.cli import apply_requests, batch_requests, main, read_requests
+from epic_db.journal import read_journal
+from epic_db.models import SequelaSetVersion
+
+
+def new_version(name):
+    return {'sequela_set_version': {
+        'sequela_set_id': 1,
+        'sequela_set_version_id': None,
+        'sequela_set_version': name,
+        'sequela_set_version_description': 'new',
+        'sequela_set_version_justification': 'bulk'}}
+
+
+def write_jsonl(path, requests):
+    with open(path, 'w') as f:
+        for request in requests:
+            f.write(json.dumps(request) + '\n\n')
+
+
+def version_names(session):
+    return [row.sequela_set_version for row in
+            session.query(SequelaSetVersion).order_by(
+                SequelaSetVersion.sequela_set_version_id)]
+
+
+def test_read_requests(tmpdir):
+    single = tmpdir.join('single.json')
+    single.write(json.dumps(new_version('a')))
+    many = tmpdir.join('many.json')
+    many.write(json.dumps([new_version('a'), new_version('b')]))
+    lines = str(tmpdir.join('many.jsonl'))
+    write_jsonl(lines, [new_version('a'), new_version('b')])
+
+    assert read_requests(str(single)) == [new_version('a')]
+    assert read_requests(str(many)) == read_requests(lines)
+    assert len(read_requests(lines)) == 2
+
+
+def test_batch_requests():
+    assert batch_requests(list(range(5)), 2) == [[0, 1], [2, 3], [4]]
+    assert batch_requests(list(range(5)), 0) == [list(range(5))]
+    assert batch_requests([], 2) == []
+
+
+def test_main_applies_files(one_set_two_versions_sqlite, tmpdir, capsys):
+    session = one_set_two_versions_sqlite.session
+    session.commit()
+    path = str(tmpdir.join('requests.jsonl'))
+    write_jsonl(path, [new_version('bulk {}'.format(i)) for i in range(5)])
+
+    assert main([path, '--batch-size', '2', '--progress']) == 0
+
+    session.expire_all()
+    assert version_names(session)[-5:] == [
+        'bulk {}'.format(i) for i in range(5)]
+    assert 'applied 5 of 5 requests' in capsys.readouterr().err
+
+
+def test_main_dry_run(one_set_two_versions_sqlite, tmpdir):
+    session = one_set_two_versions_sqlite.session
+    session.commit()
+    before = version_names(session)
+    path = str(tmpdir.join('requests.json'))
+    with open(path, 'w') as f:
+        json.dump([new_version('dry {}'.format(i)) for i in range(3)], f)
+
+    assert main([path, '--dry-run', '--batch-size', '1']) == 0
+
+    session.expire_all()
+    assert version_names(session) == before
+
+
+def test_apply_requests_stops_at_failed_batch(one_set_two_versions_sqlite):
+    session = one_set_two_versions_sqlite.session
+    session.commit()
+    bad = {'not_a_table': {'sequela_id': 11}}
+    requests = [new_version('first'), bad, new_version('never')]
+
+    failures = apply_requests(requests, batch_size=1)
+
+    assert [i for i, _ in failures] == [1]
+    assert isinstance(failures[0][1], ValueError)
+    session.expire_all()
+    names = version_names(session)
+    assert 'first' in names
+    assert 'never' not in names
+
+
+def test_main_journal(one_set_two_versions_sqlite, tmpdir):
+    session = one_set_two_versions_sqlite.session
+    session.commit()
+    path = str(tmpdir.join('requests.json'))
+    with open(path, 'w') as f:
+        json.dump(new_version('journaled'), f)
+
+    assert main([path, '--journal']) == 0
+
+    entries = read_journal(session)
+    assert [(entry.tablename, entry.operation) for entry in entries] == [
+        ('sequela_set_version', 'INSERT')]
+
+
+def test_jobs_rejected_on_shared_connection(one_set_two_versions_sqlite,
+                                            tmpdir, capsys):
+    # the in-memory test database has a single connection
+    with pytest.raises(ValueError):
+        apply_requests([new_version('a'), new_version('b')], batch_size=1,
+                       jobs=2)
+
+    path = str(tmpdir.join('requests.json'))
+    with open(path, 'w') as f:
+        json.dump(new_version('parallel'), f)
+    with pytest.raises(SystemExit):
+        main([path, '--jobs', '2'])
+    assert 'single shared connection' in capsys.readouterr().err
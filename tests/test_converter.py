@@ -0,0 +1,104 @@
+import pandas as pd
+import pytest
+
+from scripts.converter import JsonConverter, XlsProcessor
+
+
+def mapping_frame():
+    return pd.DataFrame({
+        'cause_id': [294., 294., 295., 294.],
+        'sequela_id': [11., 12., 21., 13.],
+        'sequela_name': ['test sequela 11', 'test sequela 12',
+                         'test sequela 21', 'test sequela 13'],
+        'lvl_5_name': ['test sequela 1', 'test sequela 1',
+                       'test sequela 2', 'test sequela 1']})
+
+
+def test_create_all_most_detailed():
+    converter = JsonConverter(mapping_frame())
+    output = converter.create_all_most_detailed(version_id=1)
+
+    assert [row['sequela_id'] for row in output['sequela']] == [
+        11, 12, 21, 13]
+    assert output['sequela'][2] == {
+        'sequela_id': 21,
+        'sequela_name': 'test sequela 21',
+        'sequela_hierarchy_history': {
+            'sequela_set_version_id': 1,
+            'cause_id': 295,
+            'children': None}}
+
+
+def test_create_all_aggregates():
+    converter = JsonConverter(mapping_frame())
+    assert converter.create_all_aggregates() == {'sequela': [
+        {'sequela_id': None, 'sequela_name': 'test sequela 1'},
+        {'sequela_id': None, 'sequela_name': 'test sequela 2'}]}
+
+
+def test_create_hierarchy(one_set_two_versions_sqlite):
+    db = one_set_two_versions_sqlite
+    converter = JsonConverter(mapping_frame(), session=db.session)
+
+    assert converter.create_hierarchy(version_id=2) == {
+        'sequela_hierarchy_history': [
+            {'sequela_id': 1, 'sequela_set_version_id': 2, 'cause_id': 294,
+             'children': [11, 12, 13]},
+            {'sequela_id': 2, 'sequela_set_version_id': 2, 'cause_id': 295,
+             'children': [21]}]}
+
+
+def test_resolve_names(one_set_two_versions_sqlite):
+    db = one_set_two_versions_sqlite
+    converter = JsonConverter(mapping_frame(), session=db.session)
+    converter.name_chunk_size = 2
+
+    names = ['test sequela 1', 'test sequela 2', 'test sequela 11']
+    assert converter.resolve_names(names) == {
+        'test sequela 1': 1, 'test sequela 2': 2, 'test sequela 11': 11}
+
+    with pytest.raises(ValueError) as exc:
+        converter.resolve_names(['test sequela 1', 'unknown a', 'unknown b'])
+    assert 'unknown a' in str(exc.value)
+    assert 'unknown b' in str(exc.value)
+
+
+def raw_mapping_frame(n=45):
+    # merged cells come through as blanks below their first row
+    return pd.DataFrame({
+        'cause_id': [100. + i // 10 if i % 10 == 0 else None
+                     for i in range(n)],
+        'sequela_id': [None if i % 10 == 5 else float(i + 1)
+                       for i in range(n)],
+        'sequela_name': ['sequela {}'.format(i) for i in range(n)],
+        'Name level 5 hierarchy': ['agg {}'.format(i // 10)
+                                   if i % 10 == 0 else None
+                                   for i in range(n)],
+        'Unnamed: 4': [None] * n})
+
+
+@pytest.mark.parametrize('chunksize', [4, 10, 1000])
+def test_xls_processor_chunked_csv(tmpdir, chunksize):
+    path = str(tmpdir.join('mapping.csv'))
+    raw_mapping_frame().to_csv(path, index=False)
+    processor = XlsProcessor()
+
+    expected = processor.run(path)
+    chunked = processor.run(path, chunksize=chunksize)
+
+    pd.testing.assert_frame_equal(chunked, expected, check_dtype=False)
+    assert expected.lvl_5_name.isnull().sum() == 0
+    assert list(expected.columns) == XlsProcessor._valid_columns
+
+
+def test_xls_processor_chunked_xlsx(tmpdir):
+    pytest.importorskip('openpyxl')
+    path = str(tmpdir.join('mapping.xlsx'))
+    raw_mapping_frame().to_excel(path, index=False)
+    processor = XlsProcessor()
+
+    chunks = list(processor.iter_chunks(path, chunksize=4))
+
+    assert len(chunks) > 1
+    pd.testing.assert_frame_equal(pd.concat(chunks), processor.run(path),
+                                  check_dtype=False)
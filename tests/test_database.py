@@ -0,0 +1,305 @@
+import sys
+import threading
+import types
+
+import pytest
+import sqlalchemy as sql
+
+from epic_db.database import (Config,
+                              config,
+                              create_missing_defaults,
+                              create_missing_indexes,
+                              session_scope)
+from epic_db.errors import ReadOnlySessionError
+from epic_db.metrics import MeteredQueuePool
+from epic_db.models import Base, SequelaHierarchyHistory, SequelaSet
+
+
+def test_config_is_not_reset(empty_schema_sqlite):
+    engine = config.engine
+    assert Config() is config
+    assert Config().engine is engine
+
+
+def test_named_engines():
+    config.register_engine('named', conn_str='sqlite://')
+    try:
+        engine = config.get_engine('named')
+        assert engine is not config.engine
+        assert config.get_sessionmaker('named').kw['bind'] is engine
+
+        # registering the same url again keeps the existing engine
+        config.register_engine('named', conn_str='sqlite://')
+        assert config.get_engine('named') is engine
+
+        config.register_engine('named', conn_str='sqlite://', echo=True)
+        assert config.get_engine('named') is not engine
+    finally:
+        config.remove_engine('named')
+    assert 'named' not in config.engine_names
+
+
+def test_lazy_creation_is_thread_safe():
+    config.register_engine('threaded', conn_str='sqlite://')
+    engines = []
+    threads = [threading.Thread(
+        target=lambda: engines.append(config.get_engine('threaded')))
+        for _ in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(id(engine) for engine in engines)) == 1
+    finally:
+        config.remove_engine('threaded')
+
+
+def test_engines_recreated_after_fork(tmpdir):
+    url = 'sqlite:///{}'.format(tmpdir.join('fork.db'))
+    config.register_engine('forked', conn_str=url)
+    try:
+        engine = config.get_engine('forked')
+        # pretend this process was forked from another
+        config._pid = -1
+        assert config.get_engine('forked') is not engine
+    finally:
+        config.remove_engine('forked')
+
+
+def test_session_scope_by_name(tmpdir):
+    url = 'sqlite:///{}'.format(tmpdir.join('named.db'))
+    config.register_engine('file', conn_str=url)
+    try:
+        Base.metadata.create_all(config.get_engine('file'))
+        with session_scope('file') as session:
+            session.add(SequelaSet(sequela_set_name='named set'))
+        assert sql.create_engine(url).execute(
+            'select count(*) from sequela_set').scalar() == 1
+    finally:
+        config.remove_engine('file')
+
+
+def test_configure_pool():
+    options = dict(config.pool_options)
+    try:
+        config.configure_pool(pool_size=7)
+        assert config.pool_options['pool_size'] == 7
+        with pytest.raises(ValueError):
+            config.configure_pool(pool_sizes=7)
+    finally:
+        config.pool_options = options
+
+
+def test_pool_metrics(tmpdir):
+    url = 'sqlite:///{}'.format(tmpdir.join('metrics.db'))
+    config.register_engine('metered', conn_str=url, pool_size=1,
+                           max_overflow=0, pool_timeout=0.1)
+    try:
+        engine = config.get_engine('metered')
+        metrics = config.pool_metrics('metered')
+
+        connection = engine.connect()
+        assert metrics.snapshot()['checked_out'] == 1
+        with pytest.raises(sql.exc.TimeoutError):
+            engine.connect()
+        connection.close()
+
+        snapshot = metrics.snapshot()
+        assert snapshot['checkouts'] == 1
+        assert snapshot['checked_out'] == 0
+        assert snapshot['peak_checked_out'] == 1
+        assert snapshot['checkout_timeouts'] == 1
+        assert sum(count for _, count in
+                   snapshot['wait_time_histogram']) == 1
+        assert snapshot['pool_size'] == 1
+    finally:
+        config.remove_engine('metered')
+
+
+def test_conn_def_pool_options(tmpdir, monkeypatch):
+    url = 'sqlite:///{}'.format(tmpdir.join('conn_def.db'))
+    ezfuncs = types.ModuleType('db_tools.ezfuncs')
+    ezfuncs.get_engine = lambda conn_def: sql.create_engine(url)
+    monkeypatch.setitem(sys.modules, 'db_tools',
+                        types.ModuleType('db_tools'))
+    monkeypatch.setitem(sys.modules, 'db_tools.ezfuncs', ezfuncs)
+
+    options = dict(config.pool_options)
+    config.configure_pool(pool_size=1, max_overflow=0, pool_timeout=0.1)
+    config.register_engine('conn_def', conn_def='epic')
+    try:
+        engine = config.get_engine('conn_def')
+        assert isinstance(engine.pool, MeteredQueuePool)
+        assert engine.pool.size() == 1
+
+        connection = engine.connect()
+        with pytest.raises(sql.exc.TimeoutError):
+            engine.connect()
+        connection.close()
+        assert config.pool_metrics('conn_def').snapshot()[
+            'checkout_timeouts'] == 1
+    finally:
+        config.remove_engine('conn_def')
+        config.pool_options = options
+
+
+def test_file_backed_sqlite(tmpdir):
+    url = 'sqlite:///{}'.format(tmpdir.join('local.db'))
+    config.register_engine('local', conn_str=url)
+    try:
+        engine = config.get_engine('local')
+        assert isinstance(engine.pool, MeteredQueuePool)
+        assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert engine.execute('PRAGMA synchronous').scalar() == 1
+
+        Base.metadata.create_all(engine)
+        with session_scope('local') as session:
+            session.add(SequelaSet(sequela_set_name='local set'))
+
+        # readers on separate pooled connections
+        counts = []
+
+        def read():
+            with session_scope('local') as session:
+                counts.append(session.query(SequelaSet).count())
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counts == [1] * 4
+    finally:
+        config.remove_engine('local')
+
+
+@pytest.fixture
+def primary_and_replica(tmpdir):
+    for name in ['primary', 'replica']:
+        url = 'sqlite:///{}'.format(tmpdir.join('{}.db'.format(name)))
+        config.register_engine(
+            name, conn_str=url,
+            replica_of='primary' if name == 'replica' else None)
+        Base.metadata.create_all(config.get_engine(name))
+    yield
+    config.remove_engine('primary')
+    config.remove_engine('replica')
+
+
+def test_read_only_session(primary_and_replica):
+    with session_scope('replica') as session:
+        session.add(SequelaSet(sequela_set_name='replicated set'))
+
+    with session_scope('primary', read_only=True) as session:
+        assert session.query(SequelaSet).one().sequela_set_name == (
+            'replicated set')
+
+    with pytest.raises(ReadOnlySessionError):
+        with session_scope('primary', read_only=True) as session:
+            session.add(SequelaSet(sequela_set_name='new set'))
+            session.flush()
+
+
+def test_routing_session(primary_and_replica):
+    with session_scope('replica') as session:
+        session.add(SequelaSet(sequela_set_name='replicated set'))
+
+    session = config.get_routing_sessionmaker('primary')()
+    try:
+        # reads go to the replica until the session writes
+        assert session.query(SequelaSet).count() == 1
+        session.add(SequelaSet(sequela_set_name='primary set'))
+        session.flush()
+        assert session.query(SequelaSet).one().sequela_set_name == (
+            'primary set')
+        session.commit()
+    finally:
+        session.close()
+
+    with session_scope('primary') as session:
+        assert session.query(SequelaSet).count() == 1
+
+
+def test_routing_session_text_dml(primary_and_replica):
+    session = config.get_routing_sessionmaker('primary')()
+    try:
+        session.execute(sql.text(
+            "INSERT INTO sequela_set (sequela_set_name) VALUES ('text set')"))
+        session.execute(
+            "UPDATE sequela_set SET sequela_set_name = 'renamed text set'")
+        session.commit()
+    finally:
+        session.close()
+
+    with session_scope('primary') as session:
+        assert session.query(SequelaSet).one().sequela_set_name == (
+            'renamed text set')
+    with session_scope('replica') as session:
+        assert session.query(SequelaSet).count() == 0
+
+
+def test_create_missing_indexes(empty_schema_sqlite):
+    # create_db creates every declared index
+    assert not create_missing_indexes()
+
+    index = next(index for index in SequelaHierarchyHistory.__table__.indexes
+                 if index.name == 'ix_sequela_hierarchy_history_parent_id')
+    index.drop(bind=config.engine)
+
+    assert create_missing_indexes() == [
+        'ix_sequela_hierarchy_history_parent_id']
+    assert 'ix_sequela_hierarchy_history_parent_id' in [
+        index['name'] for index in sql.inspect(config.engine).get_indexes(
+            'sequela_hierarchy_history')]
+
+
+def test_create_missing_defaults(empty_schema_sqlite, tmpdir):
+    # create_db creates every declared default
+    assert not create_missing_defaults()
+
+    # a database created before the audit timestamps had server defaults
+    engine = sql.create_engine('sqlite:///{}'.format(tmpdir.join('old.db')))
+    engine.execute('CREATE TABLE sequela (sequela_id INTEGER PRIMARY KEY, '
+                   'sequela_name VARCHAR(255), date_inserted DATETIME)')
+    try:
+        with pytest.raises(NotImplementedError) as exc:
+            create_missing_defaults(engine)
+        assert 'sequela.date_inserted' in str(exc.value)
+    finally:
+        engine.dispose()
+
+
+class _MySQLEngine(object):
+    """Stands in for an engine on a mysql database whose sequela table was
+    created before the audit timestamps had server defaults."""
+
+    def __init__(self):
+        from sqlalchemy.dialects import mysql
+        self.dialect = mysql.dialect()
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+
+
+class _OldInspector(object):
+
+    def get_table_names(self):
+        return ['sequela']
+
+    def get_columns(self, tablename):
+        return [{'name': column.name, 'default': None}
+                for column in Base.metadata.tables[tablename].columns]
+
+
+def test_create_missing_defaults_mysql(monkeypatch):
+    engine = _MySQLEngine()
+    monkeypatch.setattr(sql, 'inspect', lambda engine: _OldInspector())
+
+    assert create_missing_defaults(engine) == [
+        'sequela.active_start', 'sequela.date_inserted',
+        'sequela.last_updated']
+    assert engine.statements == [
+        'ALTER TABLE sequela ALTER COLUMN {} SET DEFAULT '
+        '(UTC_TIMESTAMP())'.format(column)
+        for column in ['active_start', 'date_inserted', 'last_updated']]
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from epic_db.export import (export_active_versions,
+                            export_version,
+                            read_manifest)
+from epic_db.models import (Sequela,
+                            SequelaSetVersion,
+                            SequelaSetVersionActive)
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def test_export_version(two_sets_four_versions_sqlite, tmpdir):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    version_4 = session.query(SequelaSetVersion).get(4)
+    version_4.add_sequela_rei(session.query(Sequela).get(11), 82)
+    session.commit()
+
+    directory = str(tmpdir)
+    entry = export_version(4, directory, batch_size=3)
+
+    # every hierarchy row of version 4 is written, in sequela_id order
+    shh = pq.read_table(os.path.join(
+        directory, entry['files']['sequela_hierarchy_history'])).to_pandas()
+    assert len(shh) == entry['row_counts']['sequela_hierarchy_history'] == 14
+    assert shh.sequela_id.tolist() == sorted(shh.sequela_id.tolist())
+
+    rei = pq.read_table(os.path.join(
+        directory, entry['files']['sequela_rei_history'])).to_pandas()
+    assert rei.rei_id.tolist() == [82]
+
+    # the fingerprint depends only on content, not on how it was streamed
+    assert export_version(4, directory, batch_size=100)['fingerprint'] == (
+        entry['fingerprint'])
+    assert read_manifest(directory)[4] == entry
+
+
+def test_export_active_versions(two_sets_four_versions_sqlite, tmpdir):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    session.add_all([
+        SequelaSetVersionActive(sequela_set_id=1, gbd_round_id=5,
+                                sequela_set_version_id=2),
+        SequelaSetVersionActive(sequela_set_id=2, gbd_round_id=5,
+                                sequela_set_version_id=4),
+        SequelaSetVersionActive(sequela_set_id=2, gbd_round_id=4,
+                                sequela_set_version_id=3)])
+    session.commit()
+
+    directory = str(tmpdir)
+    entries = export_active_versions(5, directory)
+
+    assert sorted(entries) == [2, 4]
+    assert sorted(read_manifest(directory)) == [2, 4]
+    assert entries[2]['fingerprint'] != entries[4]['fingerprint']
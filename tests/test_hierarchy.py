@@ -1,5 +1,6 @@
 from epic_db.requests import RequestHandler
-from epic_db.models import (Sequela,
+from epic_db.models import (bakery,
+                            Sequela,
                             SequelaSet,
                             SequelaSetVersion,
                             SequelaHierarchyHistory)
@@ -86,3 +87,44 @@ def test_modify_hierarchy_history(two_sets_four_versions_sqlite):
     adjusted_children = version_1.fk_sequela_hierarchy_history.filter(
         SequelaHierarchyHistory.sequela_id.in_(adj_children_ids)).all()
     assert all(child.parent_id == 0 for child in adjusted_children)
+
+
+def test_get_hierarchy_rows_cached(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    version_3 = session.query(SequelaSetVersion).get(3)
+    version_4 = session.query(SequelaSetVersion).get(4)
+
+    rows = version_3.get_hierarchy_rows([61, 62, 7])
+    assert sorted(row.sequela_id for row in rows) == [61, 62]
+    assert all(row.sequela_set_version_id == 3 for row in rows)
+    cache_size = len(bakery.cache)
+
+    # the same query shape is reused for other versions and id lists
+    rows = version_4.get_hierarchy_rows(7)
+    assert [(row.sequela_set_version_id, row.sequela_id)
+            for row in rows] == [(4, 7)]
+    assert not version_4.get_hierarchy_rows([])
+    assert len(bakery.cache) == cache_size
+
+
+def test_add_aggregate_to_unflushed_version(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+
+    aggregate = Sequela(sequela_name='aggregate of id 3 and 4')
+    session.add(aggregate)
+    session.flush()
+
+    version_1 = session.query(SequelaSetVersion).get(1)
+    version = SequelaSetVersion(sequela_set_id=1, gbd_round_id=6)
+    version.backfill_hierarchy(version_1)
+    session.add(version)
+    assert version.sequela_set_version_id is None
+
+    version.hierarchy_add_aggregate(aggregate, [3, 4], cause_id=294)
+
+    children = version.get_hierarchy_rows([3, 4])
+    assert len(children) == 2
+    assert all(child.parent_id == aggregate.sequela_id for child in children)
@@ -0,0 +1,19 @@
+import subprocess
+import sys
+
+import pytest
+
+# heavy or optional dependencies that only the code paths using them import
+LAZY_MODULES = ['numpy', 'pandas', 'pyarrow', 'gbd', 'db_tools',
+                'sqlalchemy.dialects.mysql']
+
+
+@pytest.mark.parametrize('module', ['epic_db.models', 'epic_db.requests',
+                                    'epic_db.activate', 'epic_db.cli',
+                                    'epic_db.export'])
+def test_import_is_lazy(module):
+    # a fresh interpreter, since the test session has imported everything
+    code = ('import sys, {}; print(" ".join(m for m in {!r} '
+            'if m in sys.modules))'.format(module, LAZY_MODULES))
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.decode().split() == []
@@ -0,0 +1,125 @@
+import json
+
+import sqlalchemy as sql
+from sqlalchemy.orm import sessionmaker
+
+from epic_db.journal import journaled, read_journal, replay_journal
+from epic_db.models import (Base,
+                            ChangeJournal,
+                            Sequela,
+                            SequelaReiHistory)
+from epic_db.requests import RequestHandler
+
+
+def snapshot(session_or_engine):
+    """Every row of every table except the journal, keyed by table."""
+    return {table.name: sorted(
+                tuple(row) for row in session_or_engine.execute(
+                    table.select()))
+            for table in Base.metadata.sorted_tables
+            if table.name != ChangeJournal.__tablename__}
+
+
+def copy_database(session, foreign_keys=False):
+    replica = sql.create_engine('sqlite://')
+    if foreign_keys:
+        @sql.event.listens_for(replica, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA foreign_keys = ON')
+    Base.metadata.create_all(replica)
+    for table in Base.metadata.sorted_tables:
+        rows = [dict(row) for row in session.execute(table.select())]
+        if rows:
+            replica.execute(table.insert(), rows)
+    return replica
+
+
+def apply_requests(session):
+    handler = RequestHandler(session, journal=True)
+    handler.process_request({'sequela': [
+        {'sequela_id': None, 'sequela_name': 'new aggregate',
+         'sequela_hierarchy_history': {
+             'sequela_set_version_id': 1, 'cause_id': 294,
+             'children': [3, 4]}}]}, request_id='add')
+    handler.process_request(
+        {'sequela': [{'sequela_id': 2, 'sequela_name': 'renamed'}]},
+        request_id='rename')
+    handler.process_request(
+        {'sequela': [{'sequela_id': 11, 'is_delete': True}]},
+        request_id='delete')
+
+
+def test_journal_records_changes(two_sets_four_versions_sqlite):
+    session = two_sets_four_versions_sqlite.session
+    apply_requests(session)
+
+    # the applied request ledger is journaled too, so replicas share it
+    rename = read_journal(session, request_id='rename')
+    assert [(entry.tablename, entry.operation) for entry in rename] == [
+        ('applied_request', 'INSERT'), ('sequela', 'UPDATE')]
+    assert json.loads(rename[1].primary_key) == {'sequela_id': 2}
+    assert json.loads(rename[1].before_values)['sequela_name'] == (
+        'test sequela 2')
+    assert json.loads(rename[1].after_values)['sequela_name'] == 'renamed'
+
+    added = read_journal(session, request_id='add')
+    inserts = [entry.tablename for entry in added
+               if entry.operation == 'INSERT']
+    assert inserts == ['applied_request', 'sequela',
+                       'sequela_hierarchy_history']
+
+    # journal ids only grow, so reading after an id gives the newer entries
+    entries = read_journal(session)
+    assert read_journal(session, after_journal_id=added[-1].journal_id) == (
+        entries[len(added):])
+
+
+def test_journal_off_by_default(two_sets_four_versions_sqlite):
+    session = two_sets_four_versions_sqlite.session
+    RequestHandler(session).process_request(
+        {'sequela': [{'sequela_id': 2, 'sequela_name': 'renamed'}]})
+    assert read_journal(session) == []
+
+
+def test_replay_journal(two_sets_four_versions_sqlite):
+    session = two_sets_four_versions_sqlite.session
+    replica = copy_database(session)
+    replica_session = sessionmaker(bind=replica)()
+
+    apply_requests(session)
+    assert snapshot(replica) != snapshot(session)
+    entries = read_journal(session)
+    last_id = replay_journal(entries, replica_session)
+    replica_session.commit()
+
+    assert last_id == entries[-1].journal_id
+    assert snapshot(replica) == snapshot(session)
+    assert replay_journal(
+        read_journal(session, after_journal_id=last_id),
+        replica_session) is None
+
+
+def test_replay_journal_deletes_children_first(two_sets_four_versions_sqlite):
+    session = two_sets_four_versions_sqlite.session
+    sequela = Sequela(sequela_name='short lived sequela')
+    session.add(sequela)
+    session.flush()
+    session.add(SequelaReiHistory(sequela_set_version_id=1,
+                                  sequela_id=sequela.sequela_id, rei_id=82))
+    session.commit()
+    replica = copy_database(session, foreign_keys=True)
+    replica_session = sessionmaker(bind=replica)()
+
+    # delete a sequela and the rei row referencing it in a single flush
+    with journaled(session, request_id='purge'):
+        session.delete(session.query(SequelaReiHistory).get(
+            (1, sequela.sequela_id, 82)))
+        session.delete(sequela)
+        session.flush()
+
+    entries = read_journal(session, request_id='purge')
+    assert [(entry.tablename, entry.operation) for entry in entries] == [
+        ('sequela_rei_history', 'DELETE'), ('sequela', 'DELETE')]
+    replay_journal(entries, replica_session)
+    replica_session.commit()
+    assert snapshot(replica) == snapshot(session)
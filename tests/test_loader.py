@@ -0,0 +1,111 @@
+import pandas as pd
+import pytest
+
+from epic_db.models import Sequela, SequelaSetVersion
+from scripts.loader import DataFrameLoader
+
+
+def mapping_frame():
+    return pd.DataFrame({
+        'cause_id': [294., 294., 295.],
+        'sequela_id': [101., 102., 23.],
+        'sequela_name': ['new sequela 101', 'new sequela 102',
+                         'renamed sequela 23'],
+        'lvl_5_name': ['new aggregate a', 'new aggregate a',
+                       'new aggregate b']})
+
+
+def test_load(one_set_two_versions_sqlite):
+    db = one_set_two_versions_sqlite
+    session = db.session
+    version = session.query(SequelaSetVersion).get(2)
+    num_rows_before = len(version.fk_sequela_hierarchy_history.all())
+
+    # sequela 23 exists but isn't in version 2
+    loader = DataFrameLoader(mapping_frame(), session)
+    loader.batch_size = 2
+    assert loader.load(2) == {'inserted': 4, 'renamed': 1, 'hierarchy': 5}
+
+    assert session.query(Sequela).get(23).sequela_name == (
+        'renamed sequela 23')
+    aggregate = session.query(Sequela).filter(
+        Sequela.sequela_name == 'new aggregate a').one()
+
+    rows = {row.sequela_id: row for row in
+            version.fk_sequela_hierarchy_history.all()}
+    assert len(rows) == num_rows_before + 5
+
+    agg_row = rows[aggregate.sequela_id]
+    assert (agg_row.level, agg_row.parent_id, agg_row.most_detailed) == (
+        1, 0, 0)
+    assert agg_row.path_to_top_parent == '0,{}'.format(aggregate.sequela_id)
+    assert sorted(child.sequela_id for child in agg_row.children) == [
+        101, 102]
+
+    child = rows[101]
+    assert (child.level, child.most_detailed, child.cause_id) == (2, 1, 294)
+    assert child.path_to_top_parent == '0,{},101'.format(
+        aggregate.sequela_id)
+
+    # loading the same hierarchy twice is refused
+    with pytest.raises(ValueError):
+        loader.load_hierarchy(2)
+
+
+def test_load_mixed_aggregate_causes(one_set_two_versions_sqlite):
+    session = one_set_two_versions_sqlite.session
+    num_sequela_before = session.query(Sequela).count()
+
+    frame = mapping_frame()
+    frame.loc[1, 'cause_id'] = 295.
+    loader = DataFrameLoader(frame, session)
+    with pytest.raises(ValueError) as exc:
+        loader.load(2)
+
+    assert 'new aggregate a' in str(exc.value)
+    assert 'new aggregate b' not in str(exc.value)
+    assert session.query(Sequela).count() == num_sequela_before
+
+
+def test_load_duplicate_sequela(one_set_two_versions_sqlite):
+    session = one_set_two_versions_sqlite.session
+    frame = mapping_frame()
+    frame = pd.concat([frame, frame.iloc[[0]]], ignore_index=True)
+
+    loader = DataFrameLoader(frame, session)
+    assert loader.load(2) == {'inserted': 4, 'renamed': 1, 'hierarchy': 5}
+
+
+def test_load_file(one_set_two_versions_sqlite, tmpdir):
+    session = one_set_two_versions_sqlite.session
+    version = session.query(SequelaSetVersion).get(2)
+    num_rows_before = len(version.fk_sequela_hierarchy_history.all())
+    path = str(tmpdir.join('mapping.csv'))
+    mapping_frame().to_csv(path, index=False)
+
+    # new aggregate a has a child in each chunk, and the id new aggregate a
+    # would get after the first chunk is taken by sequela 102
+    counts = DataFrameLoader.load_file(path, session, 2, chunksize=1)
+
+    assert counts == {'inserted': 4, 'renamed': 1, 'hierarchy': 5}
+    aggregate = session.query(Sequela).filter(
+        Sequela.sequela_name == 'new aggregate a').one()
+    assert session.query(Sequela).get(102).sequela_name == 'new sequela 102'
+    rows = {row.sequela_id: row for row in
+            version.fk_sequela_hierarchy_history.all()}
+    assert len(rows) == num_rows_before + 5
+    assert sorted(child.sequela_id for child in
+                  rows[aggregate.sequela_id].children) == [101, 102]
+
+
+def test_load_file_mixed_aggregate_causes(one_set_two_versions_sqlite,
+                                          tmpdir):
+    session = one_set_two_versions_sqlite.session
+    frame = mapping_frame()
+    frame.loc[1, 'cause_id'] = 295.
+    path = str(tmpdir.join('mapping.csv'))
+    frame.to_csv(path, index=False)
+
+    with pytest.raises(ValueError) as exc:
+        DataFrameLoader.load_file(path, session, 2, chunksize=1)
+    assert 'new aggregate a' in str(exc.value)
@@ -0,0 +1,53 @@
+import os
+import pstats
+
+from epic_db.models import SequelaSet
+from epic_db.profiling import PROFILE_DIR_ENV_VAR, profile_to, profiled
+from epic_db.requests import RequestHandler
+
+
+@profiled('outer')
+def outer(x):
+    return inner(x) + 1
+
+
+@profiled('inner')
+def inner(x):
+    return x * 2
+
+
+def test_profiling_off_by_default(tmpdir, monkeypatch):
+    monkeypatch.delenv(PROFILE_DIR_ENV_VAR, raising=False)
+    assert outer(1) == 3
+    assert tmpdir.listdir() == []
+
+
+def test_profile_to(tmpdir):
+    directory = str(tmpdir.join('profiles'))
+    with profile_to(directory):
+        assert outer(1) == 3
+        assert inner(1) == 2
+    outer(1)
+
+    # the nested call to inner is part of the outer profile
+    names = sorted(os.listdir(directory))
+    assert [name.split('.')[0] for name in names] == ['inner', 'outer']
+    stats = pstats.Stats(os.path.join(directory, names[1]))
+    assert any(func[2] == 'inner' for func in stats.stats)
+
+
+def test_profile_dir_env_var(two_sets_four_versions_sqlite, tmpdir,
+                             monkeypatch):
+    session = two_sets_four_versions_sqlite.session
+    monkeypatch.setenv(PROFILE_DIR_ENV_VAR, str(tmpdir))
+
+    RequestHandler(session).process_request({'sequela': [
+        {'sequela_id': 2, 'sequela_name': 'renamed'}]})
+    session.query(SequelaSet).get(2).add_version(
+        sequela_set_version='new version', gbd_round_id=5, backfill=4)
+
+    names = [path.basename.split('.')[0] for path in tmpdir.listdir()]
+    # backfill_version runs inside add_version's profile
+    assert sorted(names) == ['RequestHandler', 'SequelaSet']
+    assert any(path.basename.startswith('SequelaSet.add_version.')
+               for path in tmpdir.listdir())
@@ -0,0 +1,118 @@
+"""
+Statement budgets for the key operations.
+
+Requests flush row by row, so their budgets grow linearly with the number of
+rows; anything worse is an N+1 regression in the dynamic relationships.
+Backfills and activation work in bulk and have fixed budgets.
+"""
+import pytest
+
+from epic_db.activate import activate_sequela_set_version
+from epic_db.requests import RequestHandler
+from epic_db.models import Sequela, SequelaSet
+
+SIZES = [5, 20]
+
+
+def add_sequela_request(version_id, n, prefix='new sequela'):
+    return {'sequela': [
+        {'sequela_id': None,
+         'sequela_name': '{} {}'.format(prefix, i),
+         'sequela_hierarchy_history': {
+             'sequela_set_version_id': version_id,
+             'cause_id': 294,
+             'modelable_entity_id': 1109,
+             'healthstate_id': 1}}
+        for i in range(n)]}
+
+
+def add_sequela(session, version_id, n):
+    RequestHandler(session).process_request(
+        add_sequela_request(version_id, n))
+    return [sequela.sequela_id for sequela in session.query(Sequela).filter(
+        Sequela.sequela_name.like('new sequela %'))]
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_insert_request_budget(two_sets_four_versions_sqlite, query_budget,
+                               n):
+    handler = RequestHandler(two_sets_four_versions_sqlite.session)
+
+    with query_budget(2 * n + 1):
+        handler.process_request(add_sequela_request(1, n))
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_modify_request_budget(two_sets_four_versions_sqlite, query_budget,
+                               n):
+    session = two_sets_four_versions_sqlite.session
+    sequela_ids = add_sequela(session, 1, n)
+    request = {'sequela': [
+        {'sequela_id': sequela_id,
+         'sequela_name': 'renamed {}'.format(sequela_id)}
+        for sequela_id in sequela_ids]}
+
+    with query_budget(2 * n):
+        RequestHandler(session).process_request(request)
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_delete_request_budget(two_sets_four_versions_sqlite, query_budget,
+                               n):
+    session = two_sets_four_versions_sqlite.session
+    sequela_ids = add_sequela(session, 1, n)
+    request = {'sequela': [{'sequela_id': sequela_id, 'is_delete': True}
+                           for sequela_id in sequela_ids]}
+
+    with query_budget(2 * n):
+        RequestHandler(session).process_request(request)
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_modify_hierarchy_budget(two_sets_four_versions_sqlite, query_budget,
+                                 n):
+    session = two_sets_four_versions_sqlite.session
+    sequela_ids = add_sequela(session, 1, n)
+    request = {'sequela_hierarchy_history': [
+        {'sequela_set_version_id': 1,
+         'sequela_id': 1, 'sequela_name': 'test sequela 1',
+         'cause_id': 294, 'children': sequela_ids}]}
+
+    with query_budget(4 * n + 24):
+        RequestHandler(session).process_request(request)
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_backfill_version_budget(two_sets_four_versions_sqlite, query_budget,
+                                 n):
+    session = two_sets_four_versions_sqlite.session
+    add_sequela(session, 4, n)
+    session.commit()
+
+    with query_budget(9):
+        session.query(SequelaSet).get(2).add_version(
+            sequela_set_version='backfilled', gbd_round_id=5, backfill=4)
+        session.flush()
+
+
+@pytest.mark.parametrize('n', SIZES)
+def test_activation_budget(two_sets_four_versions_sqlite, query_budget, n):
+    session = two_sets_four_versions_sqlite.session
+    add_sequela(session, 4, n)
+    session.commit()
+
+    with query_budget(5):
+        activate_sequela_set_version(4, gbd_round_id=5)
+
+
+def test_duplicate_request_budget(two_sets_four_versions_sqlite,
+                                  query_budget):
+    session = two_sets_four_versions_sqlite.session
+    request = add_sequela_request(1, 20)
+    request['request_id'] = 'redelivered'
+    RequestHandler(session).process_request(request)
+    session.commit()
+
+    # a redelivered request costs a single ledger lookup
+    with query_budget(1):
+        assert RequestHandler(session).process_request(request) is False
@@ -1,5 +1,8 @@
+import pytest
+
 from epic_db.requests import RequestHandler
-from epic_db.models import (Sequela,
+from epic_db.models import (AppliedRequest,
+                            Sequela,
                             SequelaSet,
                             SequelaSetVersion,
                             SequelaHierarchyHistory,
@@ -174,3 +177,67 @@ def test_add_rei(two_sets_four_versions_sqlite):
     new_seq_rei = version_reis.filter(
         SequelaReiHistory.sequela_id == new_seq_id).all()
     assert len(new_seq_rei) == 1
+
+
+def test_duplicate_request_id_skipped(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+    num_versions_before = len(session.query(SequelaSetVersion).all())
+    request = {
+        'request_id': 'add-dummy-version',
+        'sequela_set_version': {
+            'sequela_set_id': 1,
+            'sequela_set_version_id': None,
+            'sequela_set_version': 'dummy'}}
+
+    handler = RequestHandler(session)
+    assert handler.process_request(request) is True
+    # a redelivered request is recognized, whether the id comes in the
+    # request or as an argument
+    assert handler.process_request(request) is False
+    assert handler.process_request(
+        {'sequela_set_version': request['sequela_set_version']},
+        request_id='add-dummy-version') is False
+
+    assert len(session.query(SequelaSetVersion).all()) == (
+        num_versions_before + 1)
+    assert handler.is_applied('add-dummy-version')
+    assert not handler.is_applied('another-request')
+
+    with pytest.raises(ValueError):
+        handler.process_request(request, request_id='another-request')
+
+
+def test_failed_request_not_in_ledger(two_sets_four_versions_sqlite):
+    db = two_sets_four_versions_sqlite
+    session = db.session
+    session.commit()
+
+    # a valid request that fails on a sequela_set that doesn't exist
+    request = {'sequela_set_version': {
+        'sequela_set_id': 99,
+        'sequela_set_version_id': None,
+        'sequela_set_version': 'orphan'}}
+    handler = RequestHandler(session)
+    with pytest.raises(ValueError):
+        handler.process_request(request, request_id='failing')
+    session.rollback()
+
+    assert session.query(AppliedRequest).get('failing') is None
+
+
+def test_duplicate_request_skips_validation(two_sets_four_versions_sqlite,
+                                            monkeypatch):
+    session = two_sets_four_versions_sqlite.session
+    handler = RequestHandler(session)
+    request = {'request_id': 'add-dummy-version',
+               'sequela_set_version': {'sequela_set_id': 1,
+                                       'sequela_set_version_id': None,
+                                       'sequela_set_version': 'dummy'}}
+    assert handler.process_request(request) is True
+
+    def fail(request):
+        raise AssertionError('validated a redelivered request')
+
+    monkeypatch.setattr('epic_db.requests.validate_request', fail)
+    assert handler.process_request(request) is False
@@ -0,0 +1,69 @@
+from sqlalchemy.dialects import mysql
+from sqlalchemy.schema import CreateTable
+
+from epic_db.models import Sequela, transaction_timestamp
+from epic_db.requests import RequestHandler
+
+
+def test_rows_share_transaction_timestamp(two_sets_four_versions_sqlite):
+    session = two_sets_four_versions_sqlite.session
+    session.commit()
+    RequestHandler(session).process_request({'sequela': [
+        {'sequela_id': None, 'sequela_name': 'new sequela {}'.format(i),
+         'sequela_hierarchy_history': {
+             'sequela_set_version_id': 1, 'cause_id': 294}}
+        for i in range(3)]})
+
+    now = transaction_timestamp(session)
+    new = session.query(Sequela).filter(
+        Sequela.sequela_name.like('new sequela %')).all()
+    assert len(new) == 3
+    for sequela in new:
+        assert sequela.date_inserted == sequela.last_updated == now
+        assert sequela.active_start == now
+        for row in sequela.fk_sequela_hierarchy_history:
+            assert row.date_inserted == row.start_date == now
+
+    session.commit()
+    assert transaction_timestamp(session) > now
+
+
+def test_modify_bumps_last_updated(two_sets_four_versions_sqlite):
+    session = two_sets_four_versions_sqlite.session
+    session.commit()
+    sequela = session.query(Sequela).get(2)
+    inserted = sequela.date_inserted
+
+    sequela.sequela_name = 'renamed'
+    session.flush()
+    assert sequela.last_updated == transaction_timestamp(session)
+    assert sequela.date_inserted == inserted
+
+    sequela.delete()
+    session.flush()
+    assert sequela.active_end == sequela.last_updated
+
+
+def test_core_insert_uses_server_default(empty_schema_sqlite):
+    from epic_db.database import config
+
+    session = config.Session()
+    session.execute(Sequela.__table__.insert(), [
+        {'sequela_id': i, 'sequela_name': 'sequela {}'.format(i)}
+        for i in range(1, 4)])
+    rows = session.query(Sequela).all()
+    assert len(rows) == 3
+    assert all(row.date_inserted is not None and row.last_updated is not None
+               for row in rows)
+    session.close()
+
+
+def test_mysql_server_defaults_are_utc():
+    # CURRENT_TIMESTAMP is in the connection's time zone on mysql
+    ddl = str(CreateTable(Sequela.__table__).compile(dialect=mysql.dialect()))
+    assert 'date_inserted DATETIME DEFAULT (UTC_TIMESTAMP())' in ddl
+    assert 'CURRENT_TIMESTAMP' not in ddl
+
+    update = str(Sequela.__table__.update().values(
+        sequela_name='renamed').compile(dialect=mysql.dialect()))
+    assert 'last_updated=(UTC_TIMESTAMP())' in update
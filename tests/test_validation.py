@@ -0,0 +1,112 @@
+import pytest
+
+from epic_db.errors import RequestValidationError
+from epic_db.requests import RequestHandler
+from epic_db.validation import get_request_schema, validate_request
+
+
+def add_sequela(i, **shh):
+    hierarchy = {'sequela_set_version_id': 1, 'cause_id': 294}
+    hierarchy.update(shh)
+    return {'sequela_id': None,
+            'sequela_name': 'new sequela {}'.format(i),
+            'sequela_hierarchy_history': hierarchy}
+
+
+def errors(request):
+    return get_request_schema().validate(request)
+
+
+def test_valid_requests():
+    assert errors({'sequela': [add_sequela(i) for i in range(3)]}) == []
+    # ids read through pandas are whole floats
+    assert errors({'sequela_hierarchy_history': [
+        {'sequela_set_version_id': 1., 'sequela_id': 1., 'cause_id': 294.,
+         'children': [11., 12]}]}) == []
+    assert errors({'sequela': {'sequela_id': 2, 'is_delete': True}}) == []
+    assert errors({'sequela_set_version': {
+        'sequela_set_id': 1, 'sequela_set_version_id': None,
+        'sequela_set_version': 'new'}}) == []
+
+
+def test_missing_insert_column_reported_with_path():
+    request = {'sequela': [add_sequela(i) for i in range(3)]}
+    del request['sequela'][2]['sequela_hierarchy_history']['cause_id']
+
+    assert errors(request) == [
+        ('sequela[2].sequela_hierarchy_history',
+         "missing columns ['cause_id'] required for insert")]
+
+
+def test_every_problem_reported():
+    request = {
+        'sequela': [
+            add_sequela(0, children='11'),
+            {'sequela_id': 'two', 'sequela_name': 'x' * 300},
+            {'sequela_id': 3, 'not_a_column': 1}],
+        'sequela_hierarchy_history': {'sequela_id': 5, 'cause_id': 294},
+        'not_a_table': {}}
+
+    assert sorted(errors(request)) == sorted([
+        ('sequela[0].sequela_hierarchy_history.children',
+         "expected a list of sequela ids, got '11'"),
+        ('sequela[1].sequela_id', "expected an integer, got 'two'"),
+        ('sequela[1].sequela_name', 'longer than 255 characters'),
+        ('sequela[2].not_a_column', 'unknown column or table'),
+        ('sequela_hierarchy_history',
+         "insert needs a sequela_set_version row: nest it in one or give "
+         "['sequela_set_version_id']"),
+        ('not_a_table', 'unknown table')])
+
+
+def test_dependencies_not_shared_between_top_level_tables():
+    request = {'sequela_set_version': {'sequela_set_id': 1,
+                                       'sequela_set_version_id': None,
+                                       'sequela_set_version': 'new'},
+               'sequela_hierarchy_history': {'sequela_id': 5,
+                                             'cause_id': 294}}
+
+    assert errors(request) == [
+        ('sequela_hierarchy_history',
+         "insert needs a sequela_set_version row: nest it in one or give "
+         "['sequela_set_version_id']")]
+
+
+def test_missing_values_from_pandas():
+    nan = float('nan')
+    assert errors({'sequela_hierarchy_history': {
+        'sequela_set_version_id': 1, 'sequela_id': 3, 'cause_id': 294,
+        'healthstate_id': nan, 'modelable_entity_id': nan}}) == []
+
+
+def test_fully_keyed_insert_checked_by_handler(two_sets_four_versions_sqlite):
+    # with its whole key given, a row can't be told to be an insert without
+    # the database, so the missing cause_id is only caught by the handler
+    session = two_sets_four_versions_sqlite.session
+    request = {'sequela_hierarchy_history': {'sequela_set_version_id': 1,
+                                             'sequela_id': 61}}
+    assert errors(request) == []
+
+    with pytest.raises(KeyError) as exc:
+        RequestHandler(session).process_request(request)
+    assert 'cause_id' in str(exc.value)
+
+
+def test_schema_compiled_once():
+    assert get_request_schema() is get_request_schema()
+
+
+def test_invalid_request_runs_no_queries(two_sets_four_versions_sqlite,
+                                         query_budget):
+    session = two_sets_four_versions_sqlite.session
+    request = {'sequela': [add_sequela(i) for i in range(50)]}
+    del request['sequela'][49]['sequela_hierarchy_history']['cause_id']
+
+    with query_budget(0):
+        with pytest.raises(RequestValidationError) as exc:
+            RequestHandler(session).process_request(request)
+    assert 'sequela[49].sequela_hierarchy_history' in str(exc.value)
+    assert len(exc.value.errors) == 1
+
+    with pytest.raises(RequestValidationError):
+        validate_request({'sequela': 'not a row'})